@@ -0,0 +1,77 @@
+# armor_maxx/async_views.py
+import logging
+
+from anthropic import AsyncAnthropic
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from rest_framework import status
+
+from users.async_views import AsyncAPIView, json_response, read_json
+from users.bungie import get_async_client
+from users.models import NewUser
+from users.profiles import aget_profile
+from .views import SYNC_COMPONENTS, OptimizeArmor, read_optimize_request
+
+logger = logging.getLogger(__name__)
+
+
+def _solve(optimizer, user, params):
+    # Runs outside the thread that serves the ORM to async code, so a long
+    # search doesn't hold up other requests; the thread's connection is
+    # closed like in any other background thread
+    try:
+        return optimizer.choose_loadout(user, params)
+    finally:
+        connection.close()
+
+
+class AsyncOptimizeArmor(AsyncAPIView):
+    # OptimizeArmor for the ASGI deployment: Bungie and Claude are awaited,
+    # the sync and the solver run in threads
+    optimizer = OptimizeArmor()
+
+    async def post(self, request, *args, **kwargs):
+        try:
+            params = read_optimize_request(read_json(request))
+        except (TypeError, ValueError) as e:
+            return json_response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            user = await NewUser.objects.aget(username=params.username)
+        except NewUser.DoesNotExist:
+            return json_response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        # Check if this is a chat-only request
+        if not params.exotic_id and not params.subclass_id:
+            try:
+                response = await self.call_claude_api(self.optimizer.chat_prompt(params.chat_input))
+                return json_response({'response': response.completion})
+            except Exception as e:
+                return json_response({'error': 'Error processing chat request'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        try:
+            data = self.optimizer.check_profile(*await aget_profile(user, SYNC_COMPONENTS))
+            await sync_to_async(self.optimizer.save_character_armor)(user, data, params.character_id, params.exotic_id)
+        except Exception as e:
+            return json_response({'error': 'Error syncing armor data'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        loadout, error = await sync_to_async(_solve, thread_sensitive=False)(self.optimizer, user, params)
+        if error:
+            return json_response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+
+        prompt = await sync_to_async(self.optimizer.build_prompt)(user, params, loadout)
+        response = await self.call_claude_api(prompt)
+        claude_response = response.content[0].text
+        logger.info(f"Claude's response details: {claude_response}")
+
+        enhanced_response = await sync_to_async(self.optimizer.finish_optimization)(user, params, claude_response, loadout)
+        if enhanced_response is None:
+            return json_response({'error': 'Failed to parse optimization suggestion'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return json_response(enhanced_response)
+
+    async def call_claude_api(self, prompt):
+        # Shares the worker's connection pool with the Bungie calls
+        anthropic = AsyncAnthropic(api_key=settings.ANTHROPIC_API_KEY, http_client=get_async_client())
+        return await anthropic.messages.create(**self.optimizer.claude_request(prompt))
@@ -0,0 +1,143 @@
+# armor_maxx/bonus_tables.py
+import threading
+from collections import namedtuple
+from itertools import combinations, combinations_with_replacement
+
+import numpy as np
+
+from .manifest import ARMOR_MODIFIERS, get_manifest_revision
+from .models import ArmorModifier
+from .optimizer import (
+    ARMOR_SLOTS, ARMOR_SLOT_NAMES, MAX_STAT_VALUE, STAT_NAMES, dominated_mask, pack_stats, score_totals,
+    wasted_points,
+)
+
+MAX_FRAGMENTS = 4
+MAX_ARMOR_MODS = 5  # one stat mod per armor piece
+UNCONSTRAINED = -10 * MAX_STAT_VALUE
+
+# Every distinct stat delta reachable for one element. Row i of vectors is
+# produced by fragment_sets[sources[i, 0]] plus mod_sets[sources[i, 1]]; the
+# sets hold indices into fragments / mods and are padded with -1.
+# dominant_vectors is a much smaller superset of the Pareto front of vectors:
+# any reachable delta is matched or beaten on every stat by one of its rows.
+BonusTable = namedtuple('BonusTable', [
+    'vectors', 'sources', 'fragment_sets', 'mod_sets', 'fragments', 'mods', 'dominant_vectors',
+])
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def _load_modifiers(queryset):
+    # Conditionally active stats aren't guaranteed, so they never count towards a build
+    rows = list(queryset.filter(is_conditionally_active=False).values_list('item_hash', 'name', *STAT_NAMES))
+    items = [(item_hash, name) for item_hash, name, *stats in rows]
+    stats = np.array([stats for item_hash, name, *stats in rows], dtype=np.int16).reshape(-1, len(STAT_NAMES))
+    return items, stats
+
+
+def _unique_sums(stats, index_sets, width):
+    # Sum each index set into a stat vector and keep the first set per distinct vector
+    sets = np.full((len(index_sets), width), -1, dtype=np.int32)
+    vectors = np.zeros((len(index_sets), len(STAT_NAMES)), dtype=np.int16)
+    for row, indices in enumerate(index_sets):
+        sets[row, :len(indices)] = indices
+        if indices:
+            vectors[row] = stats[list(indices)].sum(axis=0)
+    vectors, first = np.unique(vectors, axis=0, return_index=True)
+    return vectors, sets[first]
+
+
+def build_bonus_table(element):
+    fragments, fragment_stats = _load_modifiers(
+        ArmorModifier.objects.filter(modifier_type='SUBCLASS_FRAGMENT', subclass=element))
+    mods, mod_stats = _load_modifiers(ArmorModifier.objects.filter(modifier_type='ARMOR_MOD'))
+
+    fragment_sets = [
+        indices for size in range(MAX_FRAGMENTS + 1)
+        for indices in combinations(range(len(fragments)), size)
+    ]
+    # Mods can be repeated across armor pieces, and mods with equal stats are interchangeable
+    distinct_mods = np.unique(mod_stats, axis=0, return_index=True)[1]
+    mod_sets = [
+        indices for size in range(MAX_ARMOR_MODS + 1)
+        for indices in combinations_with_replacement(sorted(distinct_mods.tolist()), size)
+    ]
+
+    fragment_vectors, fragment_sets = _unique_sums(fragment_stats, fragment_sets, MAX_FRAGMENTS)
+    mod_vectors, mod_sets = _unique_sums(mod_stats, mod_sets, MAX_ARMOR_MODS)
+
+    vectors = (fragment_vectors[:, None, :] + mod_vectors[None, :, :]).reshape(-1, len(STAT_NAMES))
+    _, first = np.unique(pack_stats(vectors), return_index=True)
+    sources = np.stack(np.divmod(first, len(mod_vectors)), axis=1).astype(np.int32)
+
+    # A fragment or mod vector that is beaten on every stat can't help reach a
+    # target, so pairing the two fronts covers the front of the whole table
+    fragment_front = fragment_vectors[~dominated_mask(fragment_vectors)]
+    mod_front = mod_vectors[~dominated_mask(mod_vectors)]
+    dominant_vectors = np.unique(
+        (fragment_front[:, None, :] + mod_front[None, :, :]).reshape(-1, len(STAT_NAMES)), axis=0
+    )
+
+    return BonusTable(vectors[first], sources, fragment_sets, mod_sets, fragments, mods, dominant_vectors)
+
+
+def get_bonus_table(element):
+    revision = get_manifest_revision(ARMOR_MODIFIERS)
+    key = (element, revision)
+    table = _tables.get(key)
+    if table is None:
+        with _tables_lock:
+            table = _tables.get(key)
+            if table is None:
+                table = build_bonus_table(element)
+                # Tables from older revisions are stale once populate_armor_modifiers ran
+                for stale in [k for k in _tables if k[1] != revision]:
+                    del _tables[stale]
+                _tables[key] = table
+    return table
+
+
+def base_score_rules(rules, table):
+    # Rules for armor stats alone. The per-stat minimums are lowered by the
+    # largest bonus the table offers for that stat, which quickly rules out
+    # most armor, but no single bonus may reach all of them at once. Armor
+    # totals t meet the minimums when need - t is matched by some row of
+    # dominant_vectors (as in check_feasibility), i.e. when t reaches every
+    # stat of one of the corners need - row.
+    if rules.min_totals is None:
+        return rules
+    need = np.asarray(rules.min_totals, dtype=np.int64)
+    high = table.vectors.max(axis=0)
+    corners = need[None, :] - table.dominant_vectors.astype(np.int64)
+    # Stats without a minimum don't constrain the armor
+    corners[:, need <= 0] = UNCONSTRAINED
+    corners = np.unique(corners, axis=0)
+    # A corner that is higher on every stat than another one adds nothing
+    corners = corners[~dominated_mask(-corners)]
+    return rules._replace(
+        min_totals=tuple(int(need - bonus) for need, bonus in zip(rules.min_totals, high)),
+        min_corners=corners,
+    )
+
+
+def best_bonus(table, base_totals, rules):
+    # Returns None when no fragment/mod combination lifts the armor to the minimums
+    totals = np.asarray(base_totals, dtype=np.int16)[None, :] + table.vectors
+    scores = score_totals(totals, rules)
+    if scores.max() < 0:
+        return None
+    tied = np.flatnonzero(scores == scores.max())
+    row = int(tied[wasted_points(totals[tied], rules.stat_caps).argmin()])
+
+    fragment_set, mod_set = table.sources[row]
+    fragments = [
+        {'name': table.fragments[index][1], 'item_hash': table.fragments[index][0]}
+        for index in table.fragment_sets[fragment_set] if index >= 0
+    ]
+    mods = [
+        {'slot': ARMOR_SLOT_NAMES[slot], 'name': table.mods[index][1], 'item_hash': table.mods[index][0]}
+        for slot, index in zip(ARMOR_SLOTS, table.mod_sets[mod_set]) if index >= 0
+    ]
+    return fragments, mods, totals[row]
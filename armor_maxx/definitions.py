@@ -0,0 +1,35 @@
+# armor_maxx/definitions.py
+import threading
+from collections import namedtuple
+
+from .manifest import ARMOR_DEFINITIONS, get_manifest_revision
+from .models import ArmorDefinition
+
+# Read-only view of one ArmorDefinition row that the optimizer can use
+DefinitionRecord = namedtuple('DefinitionRecord', ['name', 'tier_type', 'armor_type', 'class_type'])
+
+_index = {}
+_index_revision = None
+_index_lock = threading.Lock()
+
+
+def build_definition_index():
+    # Only optimizer candidates (Legendary and Exotic armor with a slot) are
+    # kept; slot and class were derived when the manifest was ingested
+    rows = ArmorDefinition.objects.filter(is_optimizer_candidate=True).values_list(
+        'item_hash', 'name', 'tier_type', 'armor_type', 'class_type'
+    )
+    return {item_hash: DefinitionRecord(*fields) for item_hash, *fields in rows.iterator(chunk_size=2000)}
+
+
+def get_definition_index():
+    # {item_hash: DefinitionRecord}, loaded on first use in each worker and
+    # reloaded once update_armor_definitions has bumped the manifest revision
+    global _index, _index_revision
+    revision = get_manifest_revision(ARMOR_DEFINITIONS)
+    if revision != _index_revision:
+        with _index_lock:
+            if revision != _index_revision:
+                _index = build_definition_index()
+                _index_revision = revision
+    return _index
@@ -0,0 +1,119 @@
+# armor_maxx/feasibility.py
+import time
+from functools import reduce
+from math import gcd
+
+import numpy as np
+
+from .optimizer import (
+    ARMOR_SLOTS, CHUNK_SIZE, MAX_STAT_VALUE, STAT_NAMES, SlotCandidates,
+    combine_slots, decode_picks, loadout_result, pack_stats, prune_dominated, split_slots,
+)
+
+# How many distinct stat deficits are matched against the bonus front at once
+DEFICIT_BATCH_SIZE = 64
+
+
+def max_reachable_tiers(slot_candidates, bonus_table):
+    # Each stat on its own: the best piece per slot plus the best bonus for that stat
+    base = sum(slot_candidates[slot].stats.max(axis=0).astype(np.int64) for slot in ARMOR_SLOTS)
+    return np.minimum(base + bonus_table.vectors.max(axis=0), MAX_STAT_VALUE) // 10
+
+
+def exotic_variants(legendary_candidates, exotic_candidates):
+    # Candidate sets that together allow any single exotic: in each variant the
+    # exotics of one slot join that slot's legendaries
+    variants = []
+    for slot in ARMOR_SLOTS:
+        exotics = exotic_candidates[slot]
+        if len(exotics.ids):
+            legendaries = legendary_candidates[slot]
+            variants.append({**legendary_candidates, slot: SlotCandidates(
+                legendaries.ids + exotics.ids, np.concatenate([legendaries.stats, exotics.stats]),
+            )})
+    return variants or [legendary_candidates]
+
+
+def _quantize(deficits, step, low):
+    # Bonuses only move in multiples of step, so a deficit can be rounded up to
+    # the next multiple; anything below the lowest bonus is covered by every row
+    return np.maximum(-(-deficits // step) * step, low)
+
+
+def check_feasibility(slot_candidates, bonus_table, min_tiers, deadline_ms=None):
+    # Answers whether one armor set plus one reachable fragment/mod bonus meets
+    # every minimum tier. timed_out is set when the deadline ran out first, in
+    # which case feasible is False only because no set was found in time.
+    started = time.monotonic()
+    min_tiers = np.asarray(min_tiers, dtype=np.int64)
+    result = {'feasible': False, 'timed_out': False, 'loadout': None, 'explored': 0}
+
+    if not all(len(slot_candidates[slot].ids) for slot in ARMOR_SLOTS):
+        return result
+    if (min_tiers > max_reachable_tiers(slot_candidates, bonus_table)).any():
+        return result
+
+    # Dominated pieces can't meet a minimum that their dominator misses
+    slot_candidates, _ = prune_dominated(slot_candidates)
+    matrices = [slot_candidates[slot].stats for slot in ARMOR_SLOTS]
+    sizes = [len(matrix) for matrix in matrices]
+    # Stats without a minimum may even end up negative after the bonus
+    need = np.where(min_tiers > 0, min_tiers * 10, -10 * MAX_STAT_VALUE).astype(np.int16)
+
+    front = bonus_table.dominant_vectors
+    low, high = front.min(axis=0), front.max(axis=0)
+    step = reduce(gcd, np.unique(np.abs(front)).tolist(), 0) or 1
+
+    outer_slots, inner_slots = split_slots(sizes, CHUNK_SIZE)
+    outer = combine_slots([matrices[i] for i in outer_slots])
+    inner = combine_slots([matrices[i] for i in inner_slots])
+
+    # Skip outer rows that can't get there even with the best inner block and bonus
+    rows = np.flatnonzero((outer + inner.max(axis=0) + high >= need).all(axis=1))
+    rows_per_batch = max(1, CHUNK_SIZE // len(inner))
+    checked = np.zeros(0, dtype=np.int64)  # packed deficits already known to be out of reach
+
+    for start in range(0, len(rows), rows_per_batch):
+        if deadline_ms is not None and (time.monotonic() - started) * 1000 >= deadline_ms:
+            result['timed_out'] = True
+            return result
+
+        batch = rows[start:start + rows_per_batch]
+        deficits = need - (outer[batch][:, None, :] + inner[None, :, :])
+        result['explored'] += deficits.shape[0] * deficits.shape[1]
+        deficits = deficits.reshape(-1, len(STAT_NAMES))
+
+        reachable = np.flatnonzero((deficits <= high).all(axis=1))
+        if not len(reachable):
+            continue
+        deficits = _quantize(deficits[reachable], step, low)
+        keys, first = np.unique(pack_stats(deficits), return_index=True)
+        fresh = ~np.isin(keys, checked)
+        keys, first = keys[fresh], first[fresh]
+
+        for offset in range(0, len(first), DEFICIT_BATCH_SIZE):
+            candidates = deficits[first[offset:offset + DEFICIT_BATCH_SIZE]]
+            met = (front[None, :, :] >= candidates[:, None, :]).all(axis=-1).any(axis=1)
+            if met.any():
+                flat_index = int(reachable[first[offset + int(met.argmax())]])
+                batch_row, inner_index = divmod(flat_index, len(inner))
+                picks = decode_picks(sizes, outer_slots, inner_slots, int(batch[batch_row]), inner_index)
+                result['feasible'] = True
+                result['loadout'] = loadout_result(slot_candidates, matrices, picks)
+                return result
+        checked = np.union1d(checked, keys)
+
+    return result
+
+
+def check_variants(variants, bonus_table, min_tiers, deadline_ms=None):
+    # check_feasibility over each candidate set in turn, sharing one deadline
+    started = time.monotonic()
+    explored = 0
+    for slot_candidates in variants:
+        remaining = None if deadline_ms is None else max(deadline_ms - (time.monotonic() - started) * 1000, 0)
+        result = check_feasibility(slot_candidates, bonus_table, min_tiers, remaining)
+        explored += result['explored']
+        if result['feasible'] or result['timed_out']:
+            break
+    return {**result, 'explored': explored}
@@ -0,0 +1,279 @@
+# armor_maxx/ingest.py
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+
+from users import bungie
+from .manifest import (
+    ARMOR_DEFINITIONS, ARMOR_MODIFIERS, STREAM_CHUNK_BYTES, get_content_paths, is_manifest_current, iter_json_object,
+    payload_hash, record_manifest_update,
+)
+from .models import ArmorDefinition, ArmorModifier
+from .utils import get_definition_columns
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MANIFEST_URL = "https://www.bungie.net/Platform/Destiny2/Manifest/"
+ITEM_DEFINITIONS = 'DestinyInventoryItemDefinition'
+STAT_DEFINITIONS = 'DestinyStatDefinition'
+BATCH_SIZE = 500
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def cache_path(content_path):
+    # Content paths carry a hash of the file, so a cached copy never goes stale
+    name = hashlib.sha1(content_path.encode()).hexdigest()
+    return os.path.join(settings.MANIFEST_CACHE_DIR, f'{name}.json')
+
+
+def download_definition_file(content_path):
+    # Returns (local path, bytes downloaded), downloading only on a cache miss
+    path = cache_path(content_path)
+    if os.path.exists(path):
+        return path, 0
+
+    os.makedirs(settings.MANIFEST_CACHE_DIR, exist_ok=True)
+    partial = f'{path}.{os.getpid()}.{threading.get_ident()}.part'
+    size = 0
+    try:
+        with bungie.get(f'https://www.bungie.net{content_path}', 'manifest', stream=True) as response:
+            response.raise_for_status()
+            with open(partial, 'wb') as file:
+                for chunk in response.iter_content(chunk_size=STREAM_CHUNK_BYTES):
+                    file.write(chunk)
+                    size += len(chunk)
+        # Readers only ever see complete files
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return path, size
+
+
+def prune_cache(keep_paths):
+    # Drops cached files of earlier manifests
+    keep = {os.path.basename(cache_path(content_path)) for content_path in keep_paths}
+    for name in os.listdir(settings.MANIFEST_CACHE_DIR):
+        if name.endswith('.json') and name not in keep:
+            os.remove(os.path.join(settings.MANIFEST_CACHE_DIR, name))
+
+
+def read_chunks(path):
+    with open(path, 'rb') as file:
+        while chunk := file.read(STREAM_CHUNK_BYTES):
+            yield chunk
+
+
+class ArmorDefinitionWriter:
+    # Upserts new or changed armor definitions in batches
+    table = ARMOR_DEFINITIONS
+    definitions = (ITEM_DEFINITIONS,)
+    fields = [
+        'name', 'tier_type', 'item_type', 'item_sub_type', 'item_category_hashes', 'armor_type', 'class_type',
+        'is_optimizer_candidate', 'payload_hash',
+    ]
+
+    def __init__(self, definition_files, log=None):
+        self.stored_hashes = dict(ArmorDefinition.objects.values_list('item_hash', 'payload_hash'))
+        self.batch = []
+        self.total = 0
+        self.written = 0
+
+    def add(self, item_hash, item_data):
+        if item_data['itemType'] != 2:  # 2 is for Armor
+            return
+        fields = {
+            'name': item_data['displayProperties']['name'],
+            'tier_type': item_data['inventory']['tierType'],
+            'item_type': item_data['itemTypeDisplayName'],
+            'item_sub_type': item_data['itemSubType'],
+            'item_category_hashes': item_data.get('itemCategoryHashes', []),
+            **get_definition_columns(item_data.get('itemCategoryHashes', []), item_data['inventory']['tierType']),
+        }
+        self.total += 1
+        digest = payload_hash(fields)
+        if self.stored_hashes.get(item_hash) == digest:
+            return
+        self.batch.append(ArmorDefinition(item_hash=item_hash, payload_hash=digest, **fields))
+        self.written += 1
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        with transaction.atomic():
+            ArmorDefinition.objects.bulk_create(
+                self.batch, update_conflicts=True, unique_fields=['item_hash'], update_fields=self.fields,
+            )
+        self.batch = []
+
+    def finish(self):
+        if self.batch:
+            self.flush()
+        return {'total': self.total, 'written': self.written}
+
+
+class ArmorModifierWriter:
+    # Collects armor mods and subclass fragments with their stat bonuses and
+    # upserts the new or changed ones
+    table = ARMOR_MODIFIERS
+    definitions = (ITEM_DEFINITIONS, STAT_DEFINITIONS)
+    target_categories = {4104513227, 1043342778}  # armor mods and subclass mods
+    stat_fields = ('mobility', 'resilience', 'recovery', 'discipline', 'intellect', 'strength')
+    fields = [
+        'name', 'description', 'modifier_type', 'icon_url', 'subclass', *stat_fields, 'item_type_display_name',
+        'is_conditionally_active', 'payload_hash',
+    ]
+
+    def __init__(self, definition_files, log=None):
+        # The stat definitions are small enough to load whole; only the stat
+        # names are kept, as model fields
+        with open(definition_files[STAT_DEFINITIONS], 'rb') as file:
+            stat_definitions = json.load(file)
+        self.stat_names = {
+            int(stat_hash): stat_def['displayProperties']['name'].lower() for stat_hash, stat_def in stat_definitions.items()
+        }
+        self.stored_hashes = dict(ArmorModifier.objects.values_list('item_hash', 'payload_hash'))
+        self.log = log
+        self.rows = []
+        self.total = 0
+
+    def add(self, item_hash, item_def):
+        if not self.target_categories.intersection(item_def.get('itemCategoryHashes', [])):
+            return
+        if self.log:
+            self.log(f"Found item in target category: {item_def['displayProperties']['name']}")
+
+        # One pass over the investment stats; the first bonus of each stat counts
+        stats = {}
+        has_bonus = False
+        is_conditionally_active = False
+        for stat in item_def.get('investmentStats', []):
+            if stat['value'] < 5:
+                continue
+            has_bonus = True
+            is_conditionally_active = is_conditionally_active or stat['isConditionallyActive']
+            stat_name = self.stat_names.get(stat['statTypeHash'])
+            if stat_name in self.stat_fields:
+                stats.setdefault(stat_name, stat['value'])
+        if not has_bonus:
+            return
+
+        display_properties = item_def['displayProperties']
+        item_type_display_name = item_def.get('itemTypeDisplayName', '')
+        fields = {
+            'name': display_properties['name'],
+            'description': display_properties.get('description', ''),
+            'modifier_type': 'ARMOR_MOD' if 'General Armor Mod' in item_type_display_name else 'SUBCLASS_FRAGMENT',
+            'icon_url': f"https://www.bungie.net{display_properties.get('icon', '')}",
+            'subclass': item_type_display_name.split()[0] if 'Fragment' in item_type_display_name else '',
+            **{stat_field: stats.get(stat_field, 0) for stat_field in self.stat_fields},
+            'item_type_display_name': item_type_display_name,
+            'is_conditionally_active': is_conditionally_active,
+        }
+        self.total += 1
+        if self.log:
+            self.log(f"Added mod: {display_properties['name']}")
+
+        # Unchanged mods are left alone
+        digest = payload_hash(fields)
+        if self.stored_hashes.get(item_hash) != digest:
+            self.rows.append(ArmorModifier(item_hash=item_hash, payload_hash=digest, **fields))
+
+    def finish(self):
+        # There are only a few hundred mods, so they are written together once
+        # the pass is done and a failed run leaves the table as it was
+        with transaction.atomic():
+            for start in range(0, len(self.rows), BATCH_SIZE):
+                ArmorModifier.objects.bulk_create(
+                    self.rows[start:start + BATCH_SIZE], update_conflicts=True, unique_fields=['item_hash'],
+                    update_fields=self.fields,
+                )
+        return {'total': self.total, 'written': len(self.rows)}
+
+
+def run_ingestion(writer_classes, force=False, log=None):
+    # Brings the tables of writer_classes up to date with the current manifest.
+    # Every definition file is downloaded once (in parallel, through the
+    # on-disk cache) and the item definitions are parsed in a single pass that
+    # feeds all writers. Tables whose files haven't changed are skipped.
+    # Writers report each definition they pick up to log, when given.
+    # Returns a report with per-table counts, sizes and timings in seconds.
+    manifest = bungie.get(MANIFEST_URL, 'manifest').json()
+    version = manifest['Response'].get('version', '')
+    report = {'version': version, 'skipped': [], 'tables': {}, 'timings': {}}
+
+    stale = []
+    for writer_class in writer_classes:
+        content_paths = get_content_paths(manifest, *writer_class.definitions)
+        if force or not is_manifest_current(writer_class.table, content_paths):
+            stale.append((writer_class, content_paths))
+        else:
+            report['skipped'].append(writer_class.table)
+    if not stale:
+        return report
+
+    started = time.monotonic()
+    needed = {definition: path for _, content_paths in stale for definition, path in content_paths.items()}
+    with ThreadPoolExecutor(max_workers=len(needed)) as pool:
+        downloads = {definition: pool.submit(download_definition_file, path) for definition, path in needed.items()}
+        downloads = {definition: future.result() for definition, future in downloads.items()}
+    definition_files = {definition: path for definition, (path, _) in downloads.items()}
+    report['downloaded_bytes'] = sum(size for _, size in downloads.values())
+    report['cached_files'] = sum(1 for _, size in downloads.values() if size == 0)
+    report['timings']['download'] = time.monotonic() - started
+
+    started = time.monotonic()
+    writers = [(writer_class(definition_files, log), content_paths) for writer_class, content_paths in stale]
+    items = 0
+    for item_hash, item_data in iter_json_object(read_chunks(definition_files[ITEM_DEFINITIONS])):
+        items += 1
+        for writer, _ in writers:
+            writer.add(item_hash, item_data)
+    for writer, content_paths in writers:
+        counts = writer.finish()
+        # Lets every worker know its cached definitions or bonus tables are stale
+        record_manifest_update(writer.table, version, content_paths, changed=counts['written'] > 0)
+        report['tables'][writer.table] = counts
+    report['timings']['parse'] = time.monotonic() - started
+    report['items'] = items
+    report['parsed_bytes'] = os.path.getsize(definition_files[ITEM_DEFINITIONS])
+    report['peak_rss_mb'] = peak_rss_mb()
+
+    prune_cache(manifest['Response']['jsonWorldComponentContentPaths']['en'].values())
+    return report
+
+
+def describe_report(report):
+    # Lines for the manifest commands to print
+    lines = [f"{table} is up to date (manifest {report['version']})" for table in report['skipped']]
+    if not report['tables']:
+        return lines
+    megabytes = report['parsed_bytes'] / (1 << 20)
+    parse_seconds = max(report['timings']['parse'], 1e-6)
+    lines.append(
+        f"Downloaded {report['downloaded_bytes'] / (1 << 20):.1f} MB in {report['timings']['download']:.1f} s "
+        f"({report['cached_files']} files from the cache)"
+    )
+    lines.append(
+        f"Parsed {megabytes:.1f} MB, {report['items']} definitions in {parse_seconds:.1f} s "
+        f"({megabytes / parse_seconds:.1f} MB/s, {report['items'] / parse_seconds:.0f} definitions/s)"
+        + (f", peak RSS {report['peak_rss_mb']:.0f} MB" if report['peak_rss_mb'] is not None else '')
+    )
+    for table, counts in report['tables'].items():
+        lines.append(f"{table}: {counts['written']} of {counts['total']} rows written ({counts['total'] - counts['written']} unchanged)")
+    return lines
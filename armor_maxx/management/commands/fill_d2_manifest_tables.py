@@ -1,16 +1,21 @@
 from django.core.management.base import BaseCommand
-from django.core.management import call_command
+from armor_maxx.ingest import ArmorDefinitionWriter, ArmorModifierWriter, describe_report, run_ingestion
 
 class Command(BaseCommand):
     help = 'Updates armor definitions and armor modifiers'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Ingest even if the manifest files have not changed')
+
     def handle(self, *args, **options):
         self.stdout.write("Starting data update process...")
 
-        self.stdout.write("Updating armor definitions...")
-        call_command('update_armor_definitions')
-
-        self.stdout.write("Updating armor modifiers...")
-        call_command('populate_armor_modifiers')
+        # Both tables are filled from one download and one pass over the item
+        # definitions; each is skipped when its manifest files haven't changed.
+        # Each mod found is listed with -v 2
+        log = self.stdout.write if options['verbosity'] >= 2 else None
+        report = run_ingestion([ArmorDefinitionWriter, ArmorModifierWriter], force=options['force'], log=log)
+        for line in describe_report(report):
+            self.stdout.write(line)
 
-        self.stdout.write(self.style.SUCCESS("All data updated successfully!"))
\ No newline at end of file
+        self.stdout.write(self.style.SUCCESS("All data updated successfully!"))
@@ -1,93 +1,18 @@
 # armor_maxx/management/commands/populate_armor_modifiers.py
-import requests
 from django.core.management.base import BaseCommand
-from armor_maxx.models import ArmorModifier
-from django.conf import settings
+from armor_maxx.ingest import ArmorModifierWriter, describe_report, run_ingestion
 
 class Command(BaseCommand):
     help = 'Fetches mod data from Bungie API and populates the ArmorModifier table'
 
-    def handle(self, *args, **options):
-        base_url = "https://www.bungie.net"
-        manifest_url = f"{base_url}/Platform/Destiny2/Manifest/"
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Ingest even if the manifest files have not changed')
 
-        # Fetch the manifest
+    def handle(self, *args, **options):
         self.stdout.write("Fetching Destiny 2 manifest...")
-        response_manifest = requests.get(manifest_url)
-        manifest = response_manifest.json()
-
-        # Get the URLs for item and stat definitions
-        destiny_item_defs_url = f"{base_url}{manifest['Response']['jsonWorldComponentContentPaths']['en']['DestinyInventoryItemDefinition']}"
-        destiny_stat_defs_url = f"{base_url}{manifest['Response']['jsonWorldComponentContentPaths']['en']['DestinyStatDefinition']}"
-
-        # Fetch the JSON data from the URLs
-        self.stdout.write("Fetching item definitions...")
-        response_item_defs = requests.get(destiny_item_defs_url)
-        destiny_item_defs = response_item_defs.json()
-
-        self.stdout.write("Fetching stat definitions...")
-        response_stat_defs = requests.get(destiny_stat_defs_url)
-        destiny_stat_defs = response_stat_defs.json()
-
-        self.stdout.write("Processing mod data...")
-        mods = self.get_mods_from_destiny_item_defs(destiny_item_defs, destiny_stat_defs)
-
-        self.stdout.write(f"Populating ArmorModifier table with {len(mods)} mods...")
-        for item_hash, mod_data in mods.items():
-            ArmorModifier.objects.update_or_create(
-                item_hash=item_hash,
-                defaults={
-                    'name': mod_data['displayProperties']['name'],
-                    'description': mod_data['displayProperties'].get('description', ''),
-                    'modifier_type': 'ARMOR_MOD' if 'General Armor Mod' in mod_data['itemTypeDisplayName'] else 'SUBCLASS_FRAGMENT',
-                    'icon_url': f"https://www.bungie.net{mod_data['displayProperties'].get('icon', '')}",
-                    'subclass': mod_data['itemTypeDisplayName'].split()[0] if 'Fragment' in mod_data['itemTypeDisplayName'] else '',
-                    'mobility': next((stat['value'] for stat in mod_data['investmentStats'] if stat['statName'] == 'Mobility'), 0),
-                    'resilience': next((stat['value'] for stat in mod_data['investmentStats'] if stat['statName'] == 'Resilience'), 0),
-                    'recovery': next((stat['value'] for stat in mod_data['investmentStats'] if stat['statName'] == 'Recovery'), 0),
-                    'discipline': next((stat['value'] for stat in mod_data['investmentStats'] if stat['statName'] == 'Discipline'), 0),
-                    'intellect': next((stat['value'] for stat in mod_data['investmentStats'] if stat['statName'] == 'Intellect'), 0),
-                    'strength': next((stat['value'] for stat in mod_data['investmentStats'] if stat['statName'] == 'Strength'), 0),
-                    'item_type_display_name': mod_data['itemTypeDisplayName'],
-                    'is_conditionally_active': any(stat['isConditionallyActive'] for stat in mod_data['investmentStats'])
-                }
-            )
-
+        # Each mod found is listed with -v 2
+        log = self.stdout.write if options['verbosity'] >= 2 else None
+        report = run_ingestion([ArmorModifierWriter], force=options.get('force'), log=log)
+        for line in describe_report(report):
+            self.stdout.write(line)
         self.stdout.write(self.style.SUCCESS('Successfully populated ArmorModifier table'))
-
-    def get_mods_from_destiny_item_defs(self, destiny_item_defs, destiny_stat_defs):
-        mods = {}
-        target_categories = {4104513227, 1043342778}  # armor mods and subclass mods
-        
-        self.stdout.write(f"Total items in destiny_item_defs: {len(destiny_item_defs)}")
-        
-        for item_hash, item_def in destiny_item_defs.items():
-            item_category_hashes = set(item_def.get('itemCategoryHashes', []))
-            investment_stats = item_def.get('investmentStats', [])
-            
-            if target_categories.intersection(item_category_hashes):
-                self.stdout.write(f"Found item in target category: {item_def['displayProperties']['name']}")
-                
-                valid_investment_stats = []
-                for stat in investment_stats:
-                    if stat['value'] >= 5:
-                        stat_name = destiny_stat_defs[str(stat['statTypeHash'])]['displayProperties']['name']
-                        valid_investment_stats.append({
-                            'statTypeHash': stat['statTypeHash'],
-                            'statName': stat_name,
-                            'value': stat['value'],
-                            'isConditionallyActive': stat['isConditionallyActive']
-                        })
-                
-                if valid_investment_stats:
-                    mods[item_hash] = {
-                        'displayProperties': item_def['displayProperties'],
-                        'itemTypeDisplayName': item_def.get('itemTypeDisplayName', ''),
-                        'itemCategoryHashes': item_def.get('itemCategoryHashes', []),
-                        'perks': item_def.get('perks', []),
-                        'investmentStats': valid_investment_stats
-                    }
-                    self.stdout.write(f"Added mod: {item_def['displayProperties']['name']}")
-        
-        self.stdout.write(f"Total mods found: {len(mods)}")
-        return mods
\ No newline at end of file
@@ -0,0 +1,115 @@
+# armor_maxx/manifest.py
+import codecs
+import hashlib
+import json
+
+from django.db.models import F
+
+from .models import ManifestVersion
+
+ARMOR_DEFINITIONS = 'armor_definitions'
+ARMOR_MODIFIERS = 'armor_modifiers'
+
+# Definition files are read in chunks of this size instead of all at once
+STREAM_CHUNK_BYTES = 1 << 20
+
+_decoder = json.JSONDecoder()
+
+
+def get_manifest_revision(name):
+    return ManifestVersion.objects.filter(name=name).values_list('revision', flat=True).first() or 0
+
+
+def is_manifest_current(name, content_paths):
+    # True when the table was already built from these exact manifest files
+    stored = ManifestVersion.objects.filter(name=name).values_list('content_paths', flat=True).first()
+    return stored == content_paths
+
+
+def record_manifest_update(name, version='', content_paths=None, changed=True):
+    # Called by the manifest commands after they write a table. The revision
+    # only moves when rows changed, so workers keep their caches otherwise.
+    ManifestVersion.objects.get_or_create(name=name)
+    fields = {'version': version}
+    if content_paths is not None:
+        fields['content_paths'] = content_paths
+    if changed:
+        fields['revision'] = F('revision') + 1
+    ManifestVersion.objects.filter(name=name).update(**fields)
+
+
+def get_content_paths(manifest, *definitions):
+    # {definition: content path} of the English world component files
+    paths = manifest['Response']['jsonWorldComponentContentPaths']['en']
+    return {definition: paths[definition] for definition in definitions}
+
+
+def payload_hash(fields):
+    # Digest of the values a manifest command writes for one row
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+
+class _TextStream:
+    # Decoded text of a byte stream, keeping only the unread part in memory
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+
+    def more(self):
+        chunk = next(self.chunks, None)
+        text = self.utf8.decode(chunk or b'', final=chunk is None)
+        if chunk is None and not text:
+            return False
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        # Next non-whitespace character, or '' at the end of the stream
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.more():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' in manifest JSON")
+        self.pos += 1
+
+    def decode(self):
+        # One JSON value, read further until it is complete
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.more():
+                    raise
+                continue
+            # A number at the end of the buffer may go on in the next chunk
+            if end == len(self.buffer) and self.more():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_object(chunks):
+    # Yields the (key, value) members of a JSON object streamed as byte chunks,
+    # so a manifest file is never held in memory as a whole
+    stream = _TextStream(chunks)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        stream.peek()
+        key = stream.decode()
+        stream.expect(':')
+        stream.peek()
+        yield key, stream.decode()
+        if stream.peek() == '}':
+            return
+        stream.expect(',')
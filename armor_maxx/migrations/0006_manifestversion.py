@@ -0,0 +1,22 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('armor_maxx', '0005_armordefinition_item_category_hashes_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ManifestVersion',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('version', models.CharField(blank=True, max_length=100)),
+                ('revision', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+# Frozen copy of armor_maxx.utils.get_definition_columns as of this migration,
+# so later changes to the live helper don't change what the backfill wrote
+ARMOR_CATEGORY_HASHES = {
+    'HELMET': 45,
+    'GAUNTLETS': 46,
+    'CHEST_ARMOR': 47,
+    'LEG_ARMOR': 48,
+    'CLASS_ARMOR': 49,
+}
+CLASS_CATEGORY_HASHES = {
+    'WARLOCK': 21,
+    'TITAN': 22,
+    'HUNTER': 23,
+}
+OPTIMIZER_TIER_TYPES = (5, 6)
+
+
+def get_definition_columns(item_category_hashes, tier_type):
+    item_category_hashes = item_category_hashes or []
+    armor_type = next(
+        (armor_type for armor_type, hash_value in ARMOR_CATEGORY_HASHES.items() if hash_value in item_category_hashes),
+        '',
+    )
+    class_type = next(
+        (class_name for class_name, hash_value in CLASS_CATEGORY_HASHES.items() if hash_value in item_category_hashes),
+        'ALL',
+    )
+    return {
+        'armor_type': armor_type,
+        'class_type': class_type,
+        'is_optimizer_candidate': bool(armor_type) and tier_type in OPTIMIZER_TIER_TYPES,
+    }
+
+
+def backfill_derived_columns(apps, schema_editor):
+    ArmorDefinition = apps.get_model('armor_maxx', 'ArmorDefinition')
+    batch = []
+    for definition in ArmorDefinition.objects.only('item_hash', 'tier_type', 'item_category_hashes').iterator(chunk_size=2000):
+        for field, value in get_definition_columns(definition.item_category_hashes, definition.tier_type).items():
+            setattr(definition, field, value)
+        batch.append(definition)
+        if len(batch) >= 2000:
+            ArmorDefinition.objects.bulk_update(batch, ['armor_type', 'class_type', 'is_optimizer_candidate'])
+            batch = []
+    if batch:
+        ArmorDefinition.objects.bulk_update(batch, ['armor_type', 'class_type', 'is_optimizer_candidate'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('armor_maxx', '0006_manifestversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='armordefinition',
+            name='armor_type',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='armordefinition',
+            name='class_type',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='armordefinition',
+            name='is_optimizer_candidate',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='armordefinition',
+            index=models.Index(fields=['armor_type'], name='armor_maxx__armor_t_76d13f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='armordefinition',
+            index=models.Index(fields=['class_type'], name='armor_maxx__class_t_0cb9c3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='armordefinition',
+            index=models.Index(fields=['is_optimizer_candidate'], name='armor_maxx__is_opti_9c3405_idx'),
+        ),
+        migrations.RunPython(backfill_derived_columns, migrations.RunPython.noop),
+    ]
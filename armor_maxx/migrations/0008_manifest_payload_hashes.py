@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('armor_maxx', '0007_armordefinition_derived_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='armordefinition',
+            name='payload_hash',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='armormodifier',
+            name='payload_hash',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='manifestversion',
+            name='content_paths',
+            field=models.JSONField(default=dict),
+        ),
+    ]
@@ -8,11 +8,20 @@ class ArmorDefinition(models.Model):
     item_type = models.CharField(max_length=50)
     item_sub_type = models.CharField(max_length=50)
     item_category_hashes = models.JSONField(default=list)  # New field
+    # Derived from item_category_hashes and tier_type when the manifest is ingested
+    armor_type = models.CharField(max_length=20, blank=True)
+    class_type = models.CharField(max_length=10, blank=True)
+    is_optimizer_candidate = models.BooleanField(default=False)
+    # Digest of the written values, so unchanged definitions are skipped on re-ingest
+    payload_hash = models.CharField(max_length=40, blank=True)
 
     class Meta:
         indexes = [
             models.Index(fields=['tier_type']),
             models.Index(fields=['item_type']),
+            models.Index(fields=['armor_type']),
+            models.Index(fields=['class_type']),
+            models.Index(fields=['is_optimizer_candidate']),
         ]
 
 class ArmorPiece(models.Model):
@@ -85,6 +94,7 @@ class ArmorModifier(models.Model):
     # Additional fields
     item_type_display_name = models.CharField(max_length=255, blank=True)
     is_conditionally_active = models.BooleanField(default=False)
+    payload_hash = models.CharField(max_length=40, blank=True)
 
     def __str__(self):
         return f"{self.name} ({self.get_modifier_type_display()})"
@@ -92,6 +102,19 @@ class ArmorModifier(models.Model):
     class Meta:
         ordering = ['name']
 
+class ManifestVersion(models.Model):
+    # One row per manifest-derived table; revision is bumped on every write so
+    # per-process caches know when to rebuild
+    name = models.CharField(max_length=50, primary_key=True)
+    version = models.CharField(max_length=100, blank=True)
+    revision = models.PositiveIntegerField(default=0)
+    # Manifest content paths the table was last built from; they change with the file contents
+    content_paths = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} {self.version} (rev {self.revision})"
+
 class ArmorOptimizationRequest(models.Model):
     user = models.ForeignKey(NewUser, on_delete=models.CASCADE)
     exotic_id = models.CharField(max_length=100)
@@ -0,0 +1,521 @@
+# armor_maxx/optimizer.py
+import heapq
+import time
+from collections import namedtuple
+from functools import reduce
+from math import gcd
+
+import numpy as np
+
+from .models import ArmorPiece
+from .utils import STAT_HASH_TO_NAME
+
+STAT_NAMES = ['mobility', 'resilience', 'recovery', 'discipline', 'intellect', 'strength']
+ARMOR_SLOTS = ['HELMET', 'GAUNTLETS', 'CHEST_ARMOR', 'LEG_ARMOR', 'CLASS_ARMOR']
+ARMOR_SLOT_NAMES = dict(ArmorPiece.ARMOR_TYPES)
+
+MAX_STAT_VALUE = 100  # 10 tiers per stat
+MAX_TOTAL_TIERS = 34  # 340 points across all stats
+
+# Upper bound on the number of combinations scored in one broadcast. Keeps the
+# per-request working set around a few tens of MB regardless of vault size.
+CHUNK_SIZE = 1 << 20
+DEADLINE_CHUNK_SIZE = 1 << 17
+
+# Searches smaller than this stay in the request process; below it the cost of
+# shipping work to the process pool outweighs the speedup
+PARALLEL_MIN_COMBINATIONS = 1 << 24
+
+SlotCandidates = namedtuple('SlotCandidates', ['ids', 'stats'])
+
+# One search decomposed into an outer and an inner block (see split_slots)
+SearchBlocks = namedtuple('SearchBlocks', ['sizes', 'outer_slots', 'inner_slots', 'outer', 'inner'])
+
+# How loadouts are ranked: stat indices in priority order, the cap on counted
+# tiers, a per-stat cap in points (tiers above it don't count) and optional
+# per-stat minimum points; loadouts below a minimum score -1. Optional
+# min_corners refine the minimums for searches over armor stats alone: a
+# loadout only meets them when it reaches every stat of at least one row.
+ScoreRules = namedtuple(
+    'ScoreRules', ['priority_order', 'max_total_tiers', 'stat_caps', 'min_totals', 'min_corners'], defaults=(None,),
+)
+
+
+def get_priority_order(stat_priorities):
+    # Stat priorities arrive as Bungie stat hashes; any stat the user didn't rank
+    # keeps its default position after the ranked ones.
+    order = []
+    for stat in stat_priorities or []:
+        name = STAT_HASH_TO_NAME.get(str(stat), stat)
+        if name in STAT_NAMES and name not in order:
+            order.append(name)
+    order.extend(name for name in STAT_NAMES if name not in order)
+    return [STAT_NAMES.index(name) for name in order]
+
+
+def get_score_rules(stat_priorities, max_total_tiers=MAX_TOTAL_TIERS, min_tiers=None, max_tiers=None):
+    # min_tiers / max_tiers hold one tier per stat in STAT_NAMES order
+    stat_caps = (MAX_STAT_VALUE,) * len(STAT_NAMES)
+    if max_tiers:
+        stat_caps = tuple(min(int(tier) * 10, MAX_STAT_VALUE) for tier in max_tiers)
+    min_totals = None
+    if min_tiers and any(min_tiers):
+        min_totals = tuple(int(tier) * 10 for tier in min_tiers)
+    return ScoreRules(get_priority_order(stat_priorities), max_total_tiers, stat_caps, min_totals)
+
+
+def build_slot_matrices(armor_pieces, exotic_id):
+    # Returns the candidates per slot and the slot of the chosen exotic, which
+    # is None when exotic_id isn't among the given pieces
+    rows = {slot: ([], []) for slot in ARMOR_SLOTS}
+    exotic_slot = None
+
+    values = armor_pieces.values_list('item_id', 'armor_type', 'is_exotic', *STAT_NAMES)
+    for item_id, armor_type, is_exotic, *stats in values:
+        if armor_type not in rows:
+            continue
+        if is_exotic:
+            if item_id != exotic_id:
+                continue
+            exotic_slot = armor_type
+        ids, matrix = rows[armor_type]
+        ids.append(item_id)
+        matrix.append(stats)
+
+    # The chosen exotic is the only candidate for its own slot
+    if exotic_slot:
+        ids, matrix = rows[exotic_slot]
+        index = ids.index(exotic_id)
+        rows[exotic_slot] = ([ids[index]], [matrix[index]])
+
+    return {
+        slot: SlotCandidates(ids, np.array(matrix, dtype=np.int16).reshape(-1, len(STAT_NAMES)))
+        for slot, (ids, matrix) in rows.items()
+    }, exotic_slot
+
+
+def build_exotic_candidates(armor_pieces):
+    rows = {slot: ([], []) for slot in ARMOR_SLOTS}
+    values = armor_pieces.filter(is_exotic=True).values_list('item_id', 'armor_type', *STAT_NAMES)
+    for item_id, armor_type, *stats in values:
+        if armor_type in rows:
+            rows[armor_type][0].append(item_id)
+            rows[armor_type][1].append(stats)
+    return {
+        slot: SlotCandidates(ids, np.array(matrix, dtype=np.int16).reshape(-1, len(STAT_NAMES)))
+        for slot, (ids, matrix) in rows.items()
+    }
+
+
+def dominated_mask(stats, tolerance=0, dominators=1):
+    # dominated[b] is set when at least `dominators` other rows are each at
+    # least as good as b on every stat (plus the tolerance); identical rows
+    # count as dominating the copies after them. A dominating row always has a
+    # larger stat sum, so after sorting by sum each block only has to be
+    # checked against the rows kept so far: a dropped row's dominators are
+    # dominators of everything it dominates.
+    order = np.argsort(-stats.sum(axis=1, dtype=np.int64), kind='stable')
+    ordered = stats[order]
+    dominated = np.zeros(len(stats), dtype=bool)
+    front = ordered[:0]
+    for start in range(0, len(ordered), 256):
+        block = ordered[start:start + 256]
+        beaten = (front[:, None, :] >= block[None, :, :] + tolerance).all(axis=-1).sum(axis=0)
+        within = np.triu((block[:, None, :] >= block[None, :, :] + tolerance).all(axis=-1), 1)
+        beaten = beaten + within.sum(axis=0) >= dominators
+        dominated[order[start:start + len(block)]] = beaten
+        front = np.concatenate([front, block[~beaten]])
+    return dominated
+
+
+def _keep_rows(candidates, keep):
+    return SlotCandidates([item_id for item_id, kept in zip(candidates.ids, keep) if kept], candidates.stats[keep])
+
+
+def prune_dominated(slot_candidates, masterwork_tolerance=0, ignored_stats=(), top_k=1):
+    # Drop pieces that another piece in the same slot beats on all six stats.
+    # A positive tolerance only drops a piece when it is beaten by that margin,
+    # so pieces that could still overtake after masterworking are kept.
+    # Ignored stats (capped at tier 0) don't count in the comparison.
+    # For the top_k loadouts a piece has to be beaten by top_k others: swapping
+    # in each of them gives top_k loadouts that are at least as good, whereas
+    # one dominator would leave the runner-up built on the dropped piece out.
+    tolerance = np.full(len(STAT_NAMES), masterwork_tolerance, dtype=np.int64)
+    tolerance[list(ignored_stats)] = -10 * MAX_STAT_VALUE
+    pruned, removed = {}, 0
+    for slot, candidates in slot_candidates.items():
+        if len(candidates.ids) <= top_k:
+            pruned[slot] = candidates
+            continue
+        pruned[slot] = _keep_rows(candidates, ~dominated_mask(candidates.stats, tolerance, top_k))
+        removed += len(candidates.ids) - len(pruned[slot].ids)
+    return pruned, removed
+
+
+def restrict_candidates(slot_candidates, locked_ids=(), excluded_ids=()):
+    # A locked piece becomes the only candidate for its slot and excluded pieces
+    # are dropped. locked_ids may map each ID to the slot it was locked in.
+    # Returns the restricted candidates and the locked IDs that aren't among
+    # them, are in another slot, or share a slot with another locked piece.
+    if not isinstance(locked_ids, dict):
+        locked_ids = dict.fromkeys(locked_ids)
+    excluded_ids = set(excluded_ids)
+    restricted, missing = {}, set(locked_ids)
+    for slot, candidates in slot_candidates.items():
+        locked = [item_id for item_id in candidates.ids if item_id in locked_ids and locked_ids[item_id] in (None, slot)]
+        if len(locked) == 1:
+            missing.discard(locked[0])
+            keep = np.array([item_id == locked[0] for item_id in candidates.ids], dtype=bool)
+        else:
+            keep = np.array([item_id not in excluded_ids for item_id in candidates.ids], dtype=bool)
+        restricted[slot] = _keep_rows(candidates, keep)
+    return restricted, sorted(missing)
+
+
+def prune_below_minimums(slot_candidates, min_totals):
+    # Drop pieces that miss a minimum even next to the best piece of every other
+    # slot. Dropping pieces lowers those maxima, so repeat until nothing changes.
+    need = np.asarray(min_totals, dtype=np.int64)
+    removed = 0
+    while all(len(candidates.ids) for candidates in slot_candidates.values()):
+        maxima = {slot: candidates.stats.max(axis=0).astype(np.int64) for slot, candidates in slot_candidates.items()}
+        best = sum(maxima.values())
+        pruned = {}
+        for slot, candidates in slot_candidates.items():
+            keep = (candidates.stats + (best - maxima[slot]) >= need).all(axis=1)
+            pruned[slot] = _keep_rows(candidates, keep)
+        dropped = sum(len(slot_candidates[slot].ids) - len(pruned[slot].ids) for slot in pruned)
+        slot_candidates = pruned
+        removed += dropped
+        if not dropped:
+            break
+    return slot_candidates, removed
+
+
+def pack_stats(vectors):
+    # Pack each six-stat row into one int64 (10 bits per stat) so np.unique and
+    # np.isin can work on 1-D keys
+    keys = np.zeros(len(vectors), dtype=np.int64)
+    for index in range(len(STAT_NAMES)):
+        keys = (keys << 10) | (vectors[:, index].astype(np.int64) + 512)
+    return keys
+
+
+def _score_columns(columns, rules):
+    # Scores are packed into one int32 so a plain argmax ranks loadouts by total
+    # tiers first and then by tiers in priority order (base 11 keeps it lexical).
+    tiers = [np.clip(column, 0, cap) // 10 for column, cap in zip(columns, rules.stat_caps)]
+    score = np.array(tiers[0], dtype=np.int32)
+    for column in tiers[1:]:
+        score += column
+    np.minimum(score, rules.max_total_tiers, out=score)
+    for index in rules.priority_order:
+        score *= 11
+        score += tiers[index]
+    if rules.min_totals is not None:
+        short = np.zeros(score.shape, dtype=bool)
+        for column, need in zip(columns, rules.min_totals):
+            if need > 0:
+                short |= column < need
+        score[short] = -1
+    return score
+
+
+def prune_sweep_below_minimums(legendary_candidates, exotic_candidates, min_totals):
+    # prune_below_minimums for sweep_exotics: any exotic may stand in for its
+    # slot, so pieces are checked against the best legendary or exotic of every
+    # other slot. Returns both restricted candidate sets and the pieces dropped.
+    either = {
+        slot: SlotCandidates(
+            legendary_candidates[slot].ids + exotic_candidates[slot].ids,
+            np.concatenate([legendary_candidates[slot].stats, exotic_candidates[slot].stats]),
+        )
+        for slot in ARMOR_SLOTS
+    }
+    kept, removed = prune_below_minimums(either, min_totals)
+    kept_ids = {item_id for candidates in kept.values() for item_id in candidates.ids}
+    dropped_ids = [item_id for candidates in either.values() for item_id in candidates.ids if item_id not in kept_ids]
+    legendary_candidates, _ = restrict_candidates(legendary_candidates, (), dropped_ids)
+    exotic_candidates, _ = restrict_candidates(exotic_candidates, (), dropped_ids)
+    return legendary_candidates, exotic_candidates, removed
+
+
+def meets_minimums(totals, min_corners):
+    # met[i] is set when totals[i] reaches every stat of some row of min_corners
+    met = np.zeros(len(totals), dtype=bool)
+    if not len(totals):
+        return met
+    # Points above the highest corner don't matter. Capped there, a total
+    # can only reach corners whose stats add up to no more than its own.
+    high = min_corners.max(axis=0)
+    capped = np.minimum(totals, high)
+    sums = capped.sum(axis=1, dtype=np.int64)
+    corner_sums = min_corners.sum(axis=1, dtype=np.int64)
+    rows = np.flatnonzero(sums >= corner_sums.min())
+    if not len(rows):
+        return met
+
+    # Rounded down to the corners' common step many totals become equal, so
+    # each distinct one is checked once (pack_stats needs -512..511)
+    step = reduce(gcd, np.unique(np.abs(min_corners)).tolist(), 0) or 1
+    capped = np.maximum(capped[rows] // step * step, -512)
+    keys, first, inverse = np.unique(pack_stats(capped), return_index=True, return_inverse=True)
+    distinct, distinct_sums = capped[first], sums[rows][first]
+    # Corners above the highest total in some stat can't be reached
+    reachable = (min_corners <= distinct.max(axis=0)).all(axis=1)
+    min_corners, corner_sums = min_corners[reachable], corner_sums[reachable]
+
+    distinct_met = np.zeros(len(distinct), dtype=bool)
+    for start in range(0, len(distinct), 1024):
+        block = distinct[start:start + 1024]
+        corners = min_corners[corner_sums <= distinct_sums[start:start + 1024].max()]
+        distinct_met[start:start + 1024] = (block[:, None, :] >= corners[None, :, :]).all(axis=-1).any(axis=1)
+    met[rows] = distinct_met[inverse.ravel()]
+    return met
+
+
+def score_totals(totals, rules):
+    columns = [totals[..., index] for index in range(len(STAT_NAMES))]
+    return _score_columns(columns, rules)
+
+
+def wasted_points(totals, stat_caps=MAX_STAT_VALUE):
+    # Points lost to tier remainders, to stats over their cap and to negative stats
+    totals = np.asarray(totals, dtype=np.int64)
+    tiers = np.clip(totals, 0, np.asarray(stat_caps)) // 10
+    return (np.maximum(totals, 0) - tiers * 10).sum(axis=-1)
+
+
+def summarize_totals(totals):
+    totals = np.asarray(totals, dtype=np.int64)
+    tiers = np.clip(totals, 0, MAX_STAT_VALUE) // 10
+    return {
+        'total_stats': dict(zip(STAT_NAMES, totals.tolist())),
+        'tiers': dict(zip(STAT_NAMES, tiers.tolist())),
+        'total_tiers': int(tiers.sum()),
+        'wasted': int(wasted_points(totals)),
+    }
+
+
+def combine_slots(matrices):
+    # Broadcast-sum the given slot matrices into one (n1 * n2 * ..., 6) matrix
+    combined = np.zeros((1, len(STAT_NAMES)), dtype=np.int16)
+    for matrix in matrices:
+        combined = (combined[:, None, :] + matrix[None, :, :]).reshape(-1, len(STAT_NAMES))
+    return combined
+
+
+def split_slots(sizes, chunk_size):
+    # Fold the largest slots into an inner block of at most chunk_size rows; the
+    # remaining slots form the outer block that is streamed against it.
+    inner, outer = [], []
+    inner_size = 1
+    for slot in sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True):
+        if not inner or inner_size * sizes[slot] <= chunk_size:
+            inner.append(slot)
+            inner_size *= sizes[slot]
+        else:
+            outer.append(slot)
+    return sorted(outer), sorted(inner)
+
+
+def decode_picks(sizes, outer_slots, inner_slots, outer_index, inner_index):
+    # Map flat block indices back to one candidate index per slot
+    picks = [0] * len(sizes)
+    for slots, flat_index in ((outer_slots, outer_index), (inner_slots, inner_index)):
+        if slots:
+            indices = np.unravel_index(flat_index, [sizes[i] for i in slots])
+            for slot, index in zip(slots, indices):
+                picks[slot] = int(index)
+    return tuple(picks)
+
+
+def build_search_blocks(matrices, chunk_size=CHUNK_SIZE):
+    sizes = [len(matrix) for matrix in matrices]
+    outer_slots, inner_slots = split_slots(sizes, chunk_size)
+    outer = combine_slots([matrices[i] for i in outer_slots])
+    inner = combine_slots([matrices[i] for i in inner_slots])
+    return SearchBlocks(sizes, outer_slots, inner_slots, outer, inner)
+
+
+def search_loadouts(matrices, rules, deadline_ms=None, top_k=1, shard=(0, 1), shared_floor=None):
+    # Smaller batches under a deadline so the clock is checked often enough
+    chunk_size = CHUNK_SIZE if deadline_ms is None else DEADLINE_CHUNK_SIZE
+    blocks = build_search_blocks(matrices, chunk_size)
+    return search_blocks(blocks, rules, deadline_ms, top_k, shard, shared_floor)
+
+
+def search_blocks(blocks, rules, deadline_ms=None, top_k=1, shard=(0, 1), shared_floor=None, offset=None):
+    # Returns the top_k loadouts as (score, -wasted, picks) tuples, best first,
+    # where picks holds one row index per slot matrix, together with the number
+    # of combinations scored and whether the result is proven optimal.
+    # shard=(index, count) restricts the search to every count-th batch of outer
+    # rows, starting at index, so several processes can split one search.
+    # shared_floor is an optional one-element array holding a score that some
+    # concurrent shard already has top_k loadouts at or above; rows bounded
+    # below it are skipped, and this shard raises it as its own heap fills.
+    # offset is a stat vector added to every loadout, e.g. a fixed exotic piece.
+    started = time.monotonic()
+    sizes, outer_slots, inner_slots, outer, inner = blocks
+    if offset is not None:
+        outer = outer + offset
+    rows_per_batch = max(1, (CHUNK_SIZE if deadline_ms is None else DEADLINE_CHUNK_SIZE) // len(inner))
+
+    # Pairing an outer row with the per-stat maximum of the inner block bounds
+    # every loadout in that row, because scores never drop when a stat grows.
+    # Visiting rows by descending bound explores the most promising loadouts
+    # first and lets the search stop once no remaining row can make the top_k.
+    # A negative bound means no loadout in the row meets the minimums.
+    bounds = score_totals(outer + inner.max(axis=0), rules)
+    if rules.min_corners is not None:
+        bounds[~meets_minimums(outer + inner.max(axis=0), rules.min_corners)] = -1
+    order = np.argsort(-bounds, kind='stable')
+    outer, bounds = outer[order], bounds[order]
+
+    heap = []  # bounded min-heap of (score, -wasted, outer index, inner index)
+    explored, optimal = 0, True
+    shard_index, shard_count = shard
+    for start in range(shard_index * rows_per_batch, len(outer), shard_count * rows_per_batch):
+        floor = heap[0][0] if len(heap) == top_k else None
+        if shared_floor is not None and (floor is None or shared_floor[0] > floor):
+            floor = int(shared_floor[0])
+        if bounds[start] < 0 or (floor is not None and bounds[start] < floor):
+            break
+        # The first batch holds the most promising rows and always runs; after
+        # it the deadline holds whether or not a loadout was found
+        if explored and deadline_ms is not None and (time.monotonic() - started) * 1000 >= deadline_ms:
+            optimal = False
+            break
+
+        rows = outer[start:start + rows_per_batch]
+        columns = [rows[:, i, None] + inner[None, :, i] for i in range(len(STAT_NAMES))]
+        scores = _score_columns(columns, rules).ravel()
+        explored += len(scores)
+
+        # Only loadouts scoring at least the batch's k-th best (and the heap's
+        # worst entry) can enter the heap; wasted points break ties among them.
+        # The score only checks the loose per-stat minimums, so candidates
+        # missing the exact ones are dropped and the pool is widened until
+        # enough of them are left.
+        k = min(top_k, len(scores))
+        wanted = k
+        verified = None
+        while True:
+            threshold = max(np.partition(scores, len(scores) - wanted)[len(scores) - wanted], 0)
+            if len(heap) == top_k:
+                threshold = max(threshold, heap[0][0])
+            candidates = np.flatnonzero(scores >= threshold)
+            batch_rows, inner_rows = np.divmod(candidates, len(inner))
+            totals = rows[batch_rows] + inner[inner_rows]
+            if rules.min_corners is None or not len(candidates):
+                break
+            if verified is None:
+                verified = np.zeros(len(scores), dtype=bool)
+            unchecked = ~verified[candidates]
+            met = meets_minimums(totals[unchecked], rules.min_corners)
+            verified[candidates[unchecked][met]] = True
+            if met.all():
+                break
+            scores[candidates[unchecked][~met]] = -1
+            wanted = min(2 * wanted, len(scores))
+        if not len(candidates):
+            continue
+        wasted = wasted_points(totals, rules.stat_caps)
+        keys = scores[candidates].astype(np.int64) * 1000 - np.minimum(wasted, 999)
+
+        for index in np.argsort(-keys, kind='stable')[:k]:
+            entry = (
+                int(scores[candidates[index]]), -int(wasted[index]),
+                int(order[start + batch_rows[index]]), int(inner_rows[index]),
+            )
+            if len(heap) < top_k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+            else:
+                break
+
+        if shared_floor is not None and len(heap) == top_k and heap[0][0] > shared_floor[0]:
+            shared_floor[0] = heap[0][0]
+
+    ranked = sorted((
+        (score, neg_wasted, decode_picks(sizes, outer_slots, inner_slots, outer_index, inner_index))
+        for score, neg_wasted, outer_index, inner_index in heap if score >= 0
+    ), reverse=True)
+    return ranked, explored, optimal
+
+
+def loadout_result(slot_candidates, matrices, picks):
+    totals = sum(matrices[i][pick].astype(np.int64) for i, pick in enumerate(picks))
+    return {
+        'armor_pieces': [
+            {'type': ARMOR_SLOT_NAMES[slot], 'instanceId': slot_candidates[slot].ids[pick]}
+            for slot, pick in zip(ARMOR_SLOTS, picks)
+        ],
+        **summarize_totals(totals),
+    }
+
+
+def rank_totals(totals, rules):
+    # Same ordering the search uses, for loadouts ranked after the fact
+    totals = np.asarray(totals)
+    return int(score_totals(totals, rules)), -int(wasted_points(totals, rules.stat_caps))
+
+
+def find_top_loadouts(slot_candidates, rules, top_k=1, deadline_ms=None, processes=1):
+    matrices = [slot_candidates[slot].stats for slot in ARMOR_SLOTS]
+    sizes = [len(matrix) for matrix in matrices]
+    if not all(sizes):
+        return None
+
+    combinations = int(np.prod(sizes, dtype=np.int64))
+    if processes > 1 and combinations >= PARALLEL_MIN_COMBINATIONS:
+        from .parallel import search_sharded
+        ranked, explored, optimal = search_sharded(matrices, rules, deadline_ms, top_k, processes)
+    else:
+        ranked, explored, optimal = search_loadouts(matrices, rules, deadline_ms, top_k)
+
+    return {
+        'loadouts': [loadout_result(slot_candidates, matrices, picks) for _, _, picks in ranked],
+        'combinations': combinations,
+        'explored': explored,
+        'optimal': optimal,
+    }
+
+
+def sweep_exotics(legendary_candidates, exotic_candidates, rules, top_k=1):
+    # Best loadouts for every exotic, each paired with legendaries in the other
+    # four slots. Those four slots are the same for every exotic of one slot,
+    # so their outer/inner partial sums are built once per slot and each exotic
+    # only adds its stats on top.
+    results = []
+    for exotic_slot in ARMOR_SLOTS:
+        exotics = exotic_candidates[exotic_slot]
+        other_slots = [slot for slot in ARMOR_SLOTS if slot != exotic_slot]
+        if not len(exotics.ids) or not all(len(legendary_candidates[slot].ids) for slot in other_slots):
+            continue
+
+        blocks = build_search_blocks([legendary_candidates[slot].stats for slot in other_slots])
+        position = ARMOR_SLOTS.index(exotic_slot)
+        for index, item_id in enumerate(exotics.ids):
+            ranked, explored, _ = search_blocks(blocks, rules, top_k=top_k, offset=exotics.stats[index])
+            candidates = {**legendary_candidates, exotic_slot: SlotCandidates([item_id], exotics.stats[index:index + 1])}
+            matrices = [candidates[slot].stats for slot in ARMOR_SLOTS]
+            results.append({
+                'exotic_id': item_id,
+                'slot': exotic_slot,
+                'loadouts': [
+                    loadout_result(candidates, matrices, picks[:position] + (0,) + picks[position:])
+                    for _, _, picks in ranked
+                ],
+                'explored': explored,
+            })
+    return results
+
+
+def find_best_loadout(slot_candidates, rules, deadline_ms=None, processes=1):
+    result = find_top_loadouts(slot_candidates, rules, 1, deadline_ms, processes)
+    if result is None or not result['loadouts']:
+        return None
+    best = result.pop('loadouts')[0]
+    return {**best, **result}
@@ -0,0 +1,97 @@
+# armor_maxx/parallel.py
+import heapq
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain
+from multiprocessing import shared_memory
+
+import django
+import numpy as np
+
+from .optimizer import STAT_NAMES, search_loadouts
+
+_executor = None
+_executor_processes = 0
+_executor_lock = threading.Lock()
+
+
+def get_executor(processes):
+    # One pool per web worker, created on first use and reused across requests.
+    # Spawned children run django.setup() so the optimizer modules import cleanly.
+    global _executor, _executor_processes
+    with _executor_lock:
+        if _executor is None or _executor_processes != processes:
+            if _executor is not None:
+                _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup,
+            )
+            _executor_processes = processes
+        return _executor
+
+
+def _reset_executor(executor):
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+
+
+def _shared_arrays(shm, sizes):
+    # Layout: one int64 score floor shared by all shards, then the stacked slot matrices
+    shared_floor = np.ndarray((1,), dtype=np.int64, buffer=shm.buf)
+    buffer = np.ndarray((sum(sizes), len(STAT_NAMES)), dtype=np.int16, buffer=shm.buf, offset=shared_floor.nbytes)
+    return shared_floor, buffer
+
+
+def _search_shard(shm_name, sizes, shard, rules, deadline_ms, top_k):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        shared_floor, buffer = _shared_arrays(shm, sizes)
+        matrices = np.split(buffer, np.cumsum(sizes)[:-1])
+        result = search_loadouts(matrices, rules, deadline_ms, top_k, shard, shared_floor)
+        del shared_floor, buffer, matrices
+    finally:
+        shm.close()
+    return result
+
+
+def search_sharded(matrices, rules, deadline_ms, top_k, processes):
+    # Every worker runs the same outer/inner decomposition and takes every
+    # processes-th batch of outer rows (for the usual vault that means a share
+    # of the helmet x gauntlets rows). The slot matrices travel through one
+    # shared memory block instead of being pickled, next to a shared score
+    # floor so each shard prunes against the best top_k found by any shard.
+    sizes = [len(matrix) for matrix in matrices]
+    size = np.dtype(np.int64).itemsize + sum(sizes) * len(STAT_NAMES) * np.dtype(np.int16).itemsize
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        shared_floor, buffer = _shared_arrays(shm, sizes)
+        shared_floor[0] = -1
+        buffer[:] = np.concatenate(matrices)
+        del shared_floor, buffer
+
+        executor = get_executor(processes)
+        try:
+            futures = [
+                executor.submit(
+                    _search_shard, shm.name, sizes, (index, processes), rules, deadline_ms, top_k,
+                )
+                for index in range(processes)
+            ]
+            results = [future.result() for future in futures]
+        except BrokenProcessPool:
+            _reset_executor(executor)
+            raise
+    finally:
+        shm.close()
+        shm.unlink()
+
+    ranked = heapq.nlargest(top_k, chain.from_iterable(shard_ranked for shard_ranked, _, _ in results))
+    explored = sum(explored for _, explored, _ in results)
+    optimal = all(optimal for _, _, optimal in results)
+    return ranked, explored, optimal
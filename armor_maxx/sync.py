@@ -0,0 +1,69 @@
+# armor_maxx/sync.py
+import time
+
+from django.db import transaction
+
+from .models import ArmorPiece
+from .optimizer import STAT_NAMES
+
+SYNC_FIELDS = ['item_hash', 'armor_type', 'is_exotic', 'inventory_type', 'class_type', *STAT_NAMES]
+BATCH_SIZE = 500
+
+
+def _elapsed_ms(started):
+    return round((time.monotonic() - started) * 1000, 1)
+
+
+def sync_armor_pieces(user, character_ids, armor_pieces):
+    # Makes the user's ArmorPiece rows for character_ids match armor_pieces
+    # (dicts with item_id, character_id and SYNC_FIELDS). Existing rows are
+    # loaded once, the diff is computed in memory and applied in bulk inside
+    # one transaction. Returns per-phase counts and timings in ms.
+    report = {'timings': {}}
+
+    started = time.monotonic()
+    existing = {
+        (piece.character_id, piece.item_id): piece
+        for piece in ArmorPiece.objects.filter(user=user, character_id__in=character_ids)
+    }
+    report['timings']['load'] = _elapsed_ms(started)
+
+    started = time.monotonic()
+    incoming = {}
+    for armor in armor_pieces:
+        armor = {**armor, 'item_hash': str(armor['item_hash'])}
+        incoming[(armor['character_id'], armor['item_id'])] = armor
+
+    created, updated = [], []
+    for key, armor in incoming.items():
+        piece = existing.get(key)
+        if piece is None:
+            created.append(ArmorPiece(user=user, **armor))
+        elif any(getattr(piece, field) != armor[field] for field in SYNC_FIELDS):
+            for field in SYNC_FIELDS:
+                setattr(piece, field, armor[field])
+            updated.append(piece)
+    deleted = [piece.pk for key, piece in existing.items() if key not in incoming]
+    report['timings']['diff'] = _elapsed_ms(started)
+
+    started = time.monotonic()
+    with transaction.atomic():
+        if created:
+            # A concurrent sync may have inserted the same rows since they were loaded
+            ArmorPiece.objects.bulk_create(
+                created, batch_size=BATCH_SIZE, update_conflicts=True,
+                unique_fields=['user', 'item_id', 'character_id'], update_fields=SYNC_FIELDS,
+            )
+        if updated:
+            ArmorPiece.objects.bulk_update(updated, SYNC_FIELDS, batch_size=BATCH_SIZE)
+        for start in range(0, len(deleted), BATCH_SIZE):
+            ArmorPiece.objects.filter(pk__in=deleted[start:start + BATCH_SIZE]).delete()
+    report['timings']['write'] = _elapsed_ms(started)
+
+    report.update(
+        created=len(created),
+        updated=len(updated),
+        unchanged=len(incoming) - len(created) - len(updated),
+        deleted=len(deleted),
+    )
+    return report
@@ -1,3 +1,637 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import time
+from io import StringIO
+from itertools import combinations, combinations_with_replacement, product
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from users.models import NewUser
+from .bonus_tables import BonusTable, base_score_rules, best_bonus, build_bonus_table
+from .feasibility import check_feasibility, check_variants, exotic_variants
+from . import ingest
+from .manifest import ARMOR_DEFINITIONS, ARMOR_MODIFIERS, get_manifest_revision, iter_json_object
+from .models import ArmorDefinition, ArmorModifier, ArmorPiece
+from .optimizer import (
+    ARMOR_SLOTS, STAT_NAMES, SlotCandidates, dominated_mask, find_top_loadouts, get_score_rules, prune_dominated,
+    prune_sweep_below_minimums, rank_totals, restrict_candidates, score_totals, search_loadouts, sweep_exotics,
+    wasted_points,
+)
+from .parallel import _reset_executor, get_executor, search_sharded
+from .sync import sync_armor_pieces
+from .views import OptimizeArmor, parse_constraints, read_optimize_request
+
+ZERO = [0] * len(STAT_NAMES)
+
+
+def random_candidates(rng, low=1, high=6, stat_low=2, stat_high=20):
+    return {
+        slot: SlotCandidates(
+            [f'{slot}-{index}' for index in range(count)],
+            rng.integers(stat_low, stat_high, (count, len(STAT_NAMES))).astype(np.int16),
+        )
+        for slot, count in zip(ARMOR_SLOTS, rng.integers(low, high, len(ARMOR_SLOTS)))
+    }
+
+
+def make_bonus_table(vectors):
+    # A table without fragments or mods behind its rows, enough for the solver
+    vectors = np.unique(np.array(vectors, dtype=np.int16), axis=0)
+    return BonusTable(
+        vectors, np.zeros((len(vectors), 2), dtype=np.int32), np.full((1, 4), -1), np.full((1, 5), -1), [], [],
+        vectors[~dominated_mask(vectors)],
+    )
+
+
+def all_totals(slot_candidates):
+    matrices = [slot_candidates[slot].stats.astype(np.int64) for slot in ARMOR_SLOTS]
+    picks = np.array(list(product(*(range(len(matrix)) for matrix in matrices))))
+    return sum(matrix[picks[:, index]] for index, matrix in enumerate(matrices))
+
+
+def reaches_minimums(totals, table, min_tiers):
+    # Whether some row of the table lifts each total to every minimum tier
+    need = np.asarray(min_tiers) * 10
+    final = totals[:, None, :] + table.vectors[None, :, :].astype(np.int64)
+    return ((final >= need) | (need <= 0)).all(axis=-1).any(axis=1)
+
+
+def brute_force_ranks(slot_candidates, rules, top_k, eligible=None):
+    totals = all_totals(slot_candidates)
+    if eligible is not None:
+        totals = totals[eligible(totals)]
+    ranks = zip(score_totals(totals, rules).tolist(), (-wasted_points(totals, rules.stat_caps)).tolist())
+    return sorted((rank for rank in ranks if rank[0] >= 0), reverse=True)[:top_k]
+
+
+def result_ranks(result, rules):
+    return [
+        rank_totals([loadout['total_stats'][stat] for stat in STAT_NAMES], rules)
+        for loadout in result['loadouts']
+    ]
+
+
+class SolverTests(SimpleTestCase):
+    def test_matches_brute_force(self):
+        rng = np.random.default_rng(1)
+        for _ in range(60):
+            slot_candidates = random_candidates(rng)
+            rules = get_score_rules(
+                list(rng.permutation(STAT_NAMES)[:3]),
+                max_total_tiers=int(rng.integers(10, 40)),
+                max_tiers=[int(tier) for tier in rng.integers(0, 11, len(STAT_NAMES))],
+            )
+            result = find_top_loadouts(slot_candidates, rules)
+            self.assertEqual(result_ranks(result, rules), brute_force_ranks(slot_candidates, rules, 1))
+            self.assertTrue(result['optimal'])
+
+    def test_pruning_keeps_the_best(self):
+        rng = np.random.default_rng(2)
+        rules = get_score_rules([])
+        for _ in range(60):
+            slot_candidates = random_candidates(rng, 2, 7, 2, 12)
+            pruned, removed = prune_dominated(slot_candidates)
+            self.assertEqual(removed, sum(len(slot_candidates[slot].ids) - len(pruned[slot].ids) for slot in ARMOR_SLOTS))
+            result = find_top_loadouts(pruned, rules)
+            # A dominated piece can't raise the score, but may waste fewer
+            # points, so only the score is kept exactly
+            self.assertEqual(
+                [score for score, _ in result_ranks(result, rules)],
+                [score for score, _ in brute_force_ranks(slot_candidates, rules, 1)],
+            )
+
+    def test_top_k(self):
+        rng = np.random.default_rng(3)
+        rules = get_score_rules([])
+        for _ in range(60):
+            slot_candidates = random_candidates(rng, 2, 7, 2, 12)
+            top_k = int(rng.integers(2, 6))
+            result = find_top_loadouts(slot_candidates, rules, top_k)
+            self.assertEqual(result_ranks(result, rules), brute_force_ranks(slot_candidates, rules, top_k))
+
+            # A piece beaten by a single other one can still be in a runner-up
+            pruned, _ = prune_dominated(slot_candidates, top_k=top_k)
+            result = find_top_loadouts(pruned, rules, top_k)
+            self.assertEqual(
+                [score for score, _ in result_ranks(result, rules)],
+                [score for score, _ in brute_force_ranks(slot_candidates, rules, top_k)],
+            )
+
+    def test_masterwork_tolerance(self):
+        stats = np.array([[10, 10, 10, 10, 10, 10], [9, 9, 9, 9, 9, 9], [5, 5, 5, 5, 5, 5]], dtype=np.int16)
+        slot_candidates = {'HELMET': SlotCandidates(['a', 'b', 'c'], stats)}
+        self.assertEqual(prune_dominated(slot_candidates)[0]['HELMET'].ids, ['a'])
+        # Only pieces beaten by at least the tolerance on every stat are dropped
+        self.assertEqual(prune_dominated(slot_candidates, 2)[0]['HELMET'].ids, ['a', 'b'])
+        # Ignored stats don't protect a piece
+        stats[2, 0] = 20
+        self.assertEqual(prune_dominated(slot_candidates, 0, [0])[0]['HELMET'].ids, ['a'])
+
+    def test_locked_and_excluded_pieces(self):
+        rng = np.random.default_rng(3)
+        rules = get_score_rules([])
+        slot_candidates = random_candidates(rng, 3, 6)
+        locked = slot_candidates['HELMET'].ids[-1]
+        excluded = slot_candidates['GAUNTLETS'].ids[:2]
+        restricted, missing = restrict_candidates(slot_candidates, [locked], excluded)
+        self.assertEqual(missing, [])
+        self.assertEqual(restricted['HELMET'].ids, [locked])
+
+        result = find_top_loadouts(restricted, rules, 3)
+        self.assertEqual(result_ranks(result, rules), brute_force_ranks(restricted, rules, 3))
+        for loadout in result['loadouts']:
+            ids = [piece['instanceId'] for piece in loadout['armor_pieces']]
+            self.assertIn(locked, ids)
+            self.assertFalse(set(excluded) & set(ids))
+
+        _, missing = restrict_candidates(slot_candidates, [locked, 'unknown'])
+        self.assertEqual(missing, ['unknown'])
+        # A piece locked for another slot, or a second lock in one slot, doesn't apply
+        _, missing = restrict_candidates(slot_candidates, {locked: 'GAUNTLETS'})
+        self.assertEqual(missing, [locked])
+        _, missing = restrict_candidates(slot_candidates, slot_candidates['HELMET'].ids[:2])
+        self.assertEqual(missing, slot_candidates['HELMET'].ids[:2])
+
+    def test_minimum_tiers(self):
+        rng = np.random.default_rng(4)
+        for _ in range(150):
+            vectors = [ZERO] + [
+                list(rng.choice([0, 0, 3, 5, 7, 10, -4, -10], len(STAT_NAMES))) for _ in range(int(rng.integers(1, 8)))
+            ]
+            table = make_bonus_table(vectors)
+            slot_candidates = random_candidates(rng, 1, 5)
+            min_tiers = [int(tier) for tier in rng.integers(0, 9, len(STAT_NAMES))]
+            rules = get_score_rules([], min_tiers=min_tiers)
+            base_rules = base_score_rules(rules, table)
+            top_k = int(rng.integers(1, 4))
+
+            result = find_top_loadouts(slot_candidates, base_rules, top_k)
+            expected = brute_force_ranks(
+                slot_candidates, base_rules, top_k, lambda totals: reaches_minimums(totals, table, min_tiers),
+            )
+            self.assertEqual(result_ranks(result, base_rules), expected)
+            for loadout in result['loadouts']:
+                totals = [loadout['total_stats'][stat] for stat in STAT_NAMES]
+                self.assertIsNotNone(best_bonus(table, totals, rules))
+
+    def test_minimums_only_met_by_a_weaker_set(self):
+        # Each bonus lifts one stat, so only the set with 50 mobility on its
+        # own reaches 5 tiers in both mobility and resilience
+        table = make_bonus_table([ZERO, [10, 0, 0, 0, 0, 0], [0, 10, 0, 0, 0, 0]])
+        stats = np.array([[9, 9, 20, 20, 20, 20], [9, 9, 19, 20, 20, 20], [10, 8, 2, 2, 2, 2]], dtype=np.int16)
+        slot_candidates = {slot: SlotCandidates([f'{slot}-{index}' for index in range(3)], stats) for slot in ARMOR_SLOTS}
+        rules = get_score_rules([], min_tiers=[5, 5, 0, 0, 0, 0])
+
+        result = find_top_loadouts(slot_candidates, base_score_rules(rules, table))
+        totals = [result['loadouts'][0]['total_stats'][stat] for stat in STAT_NAMES]
+        self.assertIsNotNone(best_bonus(table, totals, rules))
+
+    def test_deadline_returns_best_so_far(self):
+        rng = np.random.default_rng(5)
+        slot_candidates = random_candidates(rng, 8, 12)
+        result = find_top_loadouts(slot_candidates, get_score_rules([]), deadline_ms=0)
+        self.assertEqual(len(result['loadouts']), 1)
+
+    def test_deadline_without_a_valid_loadout(self):
+        # Mobility and resilience add up to 30 on every piece, so 8 tiers in
+        # both can't be met, yet every row passes the bound check
+        rng = np.random.default_rng(6)
+        slot_candidates = {}
+        for slot in ARMOR_SLOTS:
+            stats = rng.integers(2, 30, (40, len(STAT_NAMES))).astype(np.int16)
+            stats[:, 1] = 30 - stats[:, 0]
+            slot_candidates[slot] = SlotCandidates([f'{slot}-{index}' for index in range(40)], stats)
+        rules = get_score_rules([], min_tiers=[8, 8, 0, 0, 0, 0])
+
+        started = time.monotonic()
+        result = find_top_loadouts(slot_candidates, rules, deadline_ms=20)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(result['loadouts'], [])
+        self.assertFalse(result['optimal'])
+        self.assertLess(result['explored'], result['combinations'])
+
+    def test_shards_cover_the_search(self):
+        rng = np.random.default_rng(7)
+        matrices = [rng.integers(2, 30, (12, len(STAT_NAMES))).astype(np.int16) for _ in ARMOR_SLOTS]
+        rules = get_score_rules([], min_tiers=[7, 7, 4, 0, 0, 0])
+        expected, _, _ = search_loadouts(matrices, rules, top_k=5)
+        self.assertEqual(len(expected), 5)
+
+        shards = [search_loadouts(matrices, rules, top_k=5, shard=(index, 3)) for index in range(3)]
+        merged = sorted((entry for ranked, _, _ in shards for entry in ranked), reverse=True)[:5]
+        self.assertEqual([entry[:2] for entry in merged], [entry[:2] for entry in expected])
+
+        executor = get_executor(2)
+        self.addCleanup(_reset_executor, executor)
+        self.addCleanup(executor.shutdown)
+        ranked, _, optimal = search_sharded(matrices, rules, None, 5, 2)
+        self.assertEqual([entry[:2] for entry in ranked], [entry[:2] for entry in expected])
+        self.assertTrue(optimal)
+
+    def test_sweep_exotics(self):
+        rng = np.random.default_rng(11)
+        for min_tiers in [ZERO, [7, 6, 5, 0, 0, 0]]:
+            rules = get_score_rules([], min_tiers=min_tiers)
+            legendaries = random_candidates(rng, 2, 5)
+            exotics = random_candidates(rng, 0, 3, 5, 25)
+            results = sweep_exotics(legendaries, exotics, rules, 2)
+            self.assertEqual(len(results), sum(len(exotics[slot].ids) for slot in ARMOR_SLOTS))
+            for result in results:
+                index = exotics[result['slot']].ids.index(result['exotic_id'])
+                candidates = {
+                    **legendaries,
+                    result['slot']: SlotCandidates([result['exotic_id']], exotics[result['slot']].stats[index:index + 1]),
+                }
+                self.assertEqual(result_ranks(result, rules), brute_force_ranks(candidates, rules, 2))
+
+            # Pruning below the minimums keeps every exotic's best loadouts
+            if rules.min_totals is None:
+                continue
+            pruned_legendaries, pruned_exotics, _ = prune_sweep_below_minimums(legendaries, exotics, rules.min_totals)
+            pruned = {result['exotic_id']: result_ranks(result, rules) for result in sweep_exotics(
+                pruned_legendaries, pruned_exotics, rules, 2,
+            )}
+            for result in results:
+                self.assertEqual(pruned.get(result['exotic_id'], []), result_ranks(result, rules))
+
+    def test_feasibility(self):
+        rng = np.random.default_rng(8)
+        for _ in range(60):
+            table = make_bonus_table([ZERO] + [
+                list(rng.choice([0, 5, 10, 20, -10], len(STAT_NAMES))) for _ in range(int(rng.integers(1, 6)))
+            ])
+            slot_candidates = random_candidates(rng, 1, 5)
+            min_tiers = [int(tier) for tier in rng.integers(0, 7, len(STAT_NAMES))]
+            result = check_feasibility(slot_candidates, table, min_tiers)
+            self.assertEqual(result['feasible'], reaches_minimums(all_totals(slot_candidates), table, min_tiers).any())
+            self.assertFalse(result['timed_out'])
+            if result['feasible']:
+                totals = np.array([[result['loadout']['total_stats'][stat] for stat in STAT_NAMES]])
+                self.assertTrue(reaches_minimums(totals, table, min_tiers)[0])
+
+    def test_feasibility_with_any_single_exotic(self):
+        rng = np.random.default_rng(9)
+        table = make_bonus_table([ZERO])
+        for _ in range(40):
+            legendary = random_candidates(rng, 1, 4)
+            exotic = {
+                slot: SlotCandidates([f'exotic-{item_id}' for item_id in candidates.ids], candidates.stats)
+                for slot, candidates in random_candidates(rng, 0, 3, 10, 30).items()
+            }
+            min_tiers = [int(tier) for tier in rng.integers(0, 8, len(STAT_NAMES))]
+
+            # Every set with no exotic or exactly one
+            sets = [legendary] + [
+                {**legendary, slot: SlotCandidates(exotic[slot].ids[index:index + 1], exotic[slot].stats[index:index + 1])}
+                for slot in ARMOR_SLOTS for index in range(len(exotic[slot].ids))
+            ]
+            expected = any(reaches_minimums(all_totals(candidates), table, min_tiers).any() for candidates in sets)
+            result = check_variants(exotic_variants(legendary, exotic), table, min_tiers)
+            self.assertEqual(result['feasible'], expected)
+            if result['feasible']:
+                worn = [piece['instanceId'] for piece in result['loadout']['armor_pieces']]
+                self.assertLessEqual(sum(item_id.startswith('exotic-') for item_id in worn), 1)
+
+    def test_feasibility_deadline(self):
+        rng = np.random.default_rng(10)
+        slot_candidates = random_candidates(rng, 8, 12)
+        table = make_bonus_table([ZERO])
+        result = check_variants([slot_candidates, slot_candidates], table, [1, 0, 0, 0, 0, 0], deadline_ms=0)
+        self.assertTrue(result['timed_out'])
+        self.assertFalse(result['feasible'])
+
+
+class RequestParsingTests(SimpleTestCase):
+    def test_malformed_values_raise(self):
+        for data, message in [
+            ({'masterworkTolerance': None}, 'masterworkTolerance must be an integer'),
+            ({'resultCount': '2.5'}, 'resultCount must be an integer'),
+            ({'deadlineMs': {}}, 'deadlineMs must be a number'),
+            ({'exoticId': 'not an object'}, 'exoticId must be an object'),
+            ({'constraints': {'minTiers': {'mobility': None}}}, 'mobility tier must be an integer'),
+            ({'constraints': {'maxTotalTiers': 'lots'}}, 'maxTotalTiers must be an integer'),
+            ({'constraints': ['lockedItems']}, 'constraints must be an object'),
+            ({'constraints': {'lockedItems': 5}}, 'lockedItems must be a list or an object'),
+            ({'constraints': {'lockedItems': {'Hat': '1'}}}, 'Unknown armor slot: Hat'),
+            ({'constraints': {'lockedItems': {'HELMET': '1', 'Helmet': '2'}}}, 'Only one locked item per slot: Helmet'),
+        ]:
+            with self.assertRaisesMessage(ValueError, message):
+                read_optimize_request(data)
+
+    def test_locked_items(self):
+        self.assertEqual(parse_constraints({'lockedItems': [1, '2']})[0], {'1': None, '2': None})
+        self.assertEqual(
+            parse_constraints({'lockedItems': {'Chest Armor': 1, 'HELMET': '2'}})[0],
+            {'1': 'CHEST_ARMOR', '2': 'HELMET'},
+        )
+
+    def test_max_total_tiers_is_clamped(self):
+        self.assertEqual(parse_constraints({'maxTotalTiers': 99})[4], 60)
+        self.assertEqual(parse_constraints({'maxTotalTiers': -3})[4], 0)
+
+
+class SweepExoticsViewTests(SimpleTestCase):
+    def test_request_is_checked_before_syncing(self):
+        # SimpleTestCase refuses database queries, so these fail before any lookup
+        for data, message in [
+            ({'username': 'guardian'}, 'characterId is required unless allCharacters is set'),
+            ({'username': 'guardian', 'characterId': '1', 'masterworkTolerance': 'x'}, 'masterworkTolerance must be an integer'),
+        ]:
+            response = self.client.post(reverse('sweep_exotics'), data, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'error': message})
+
+
+class BonusTableTests(TestCase):
+    def add_modifier(self, item_hash, modifier_type, subclass='', conditional=False, **stats):
+        ArmorModifier.objects.create(
+            item_hash=item_hash, name=f'Modifier {item_hash}', modifier_type=modifier_type, subclass=subclass,
+            is_conditionally_active=conditional, **stats,
+        )
+
+    def test_every_combination_is_covered(self):
+        self.add_modifier('1', 'SUBCLASS_FRAGMENT', 'Void', mobility=10, resilience=-10)
+        self.add_modifier('2', 'SUBCLASS_FRAGMENT', 'Void', recovery=10)
+        self.add_modifier('3', 'SUBCLASS_FRAGMENT', 'Void', discipline=20, conditional=True)
+        self.add_modifier('4', 'SUBCLASS_FRAGMENT', 'Solar', intellect=10)
+        self.add_modifier('5', 'ARMOR_MOD', mobility=10)
+        self.add_modifier('6', 'ARMOR_MOD', mobility=5)
+        self.add_modifier('7', 'ARMOR_MOD', resilience=10)
+        table = build_bonus_table('Void')
+
+        fragments = [np.array([10, -10, 0, 0, 0, 0]), np.array([0, 0, 10, 0, 0, 0])]
+        mods = [np.array([10, 0, 0, 0, 0, 0]), np.array([5, 0, 0, 0, 0, 0]), np.array([0, 10, 0, 0, 0, 0])]
+        expected = {
+            tuple(sum(fragment_set, np.zeros(6, dtype=int)) + sum(mod_set, np.zeros(6, dtype=int)))
+            for size in range(3) for fragment_set in combinations(fragments, size)
+            for count in range(6) for mod_set in combinations_with_replacement(mods, count)
+        }
+        self.assertEqual({tuple(vector) for vector in table.vectors.tolist()}, expected)
+
+        # Every row is the sum of the fragments and mods it names
+        for vector, (fragment_set, mod_set) in zip(table.vectors, table.sources):
+            hashes = [table.fragments[index][0] for index in table.fragment_sets[fragment_set] if index >= 0]
+            hashes += [table.mods[index][0] for index in table.mod_sets[mod_set] if index >= 0]
+            total = np.zeros(len(STAT_NAMES), dtype=int)
+            for item_hash in hashes:
+                total += list(ArmorModifier.objects.filter(item_hash=item_hash).values_list(*STAT_NAMES).get())
+            self.assertEqual(total.tolist(), vector.tolist())
+
+        # dominant_vectors matches or beats every row
+        covered = (table.dominant_vectors[None, :, :] >= table.vectors[:, None, :]).all(axis=-1).any(axis=1)
+        self.assertTrue(covered.all())
+
+
+class IterJsonObjectTests(SimpleTestCase):
+    document = {
+        '1': {'name': 'Ward of Dawn {', 'tags': ['a', 'b}', '"quoted"'], 'value': 12345},
+        '2': {'name': 'Café — \U0001F31F', 'escaped': 'back\\slash \\" and \n newline'},
+        '3': [1.5, -2, None, True, {'nested': {}}],
+        '4': 9876543210,
+    }
+
+    def chunked(self, data, size):
+        return [data[start:start + size] for start in range(0, len(data), size)]
+
+    def test_every_chunk_size(self):
+        data = json.dumps(self.document, ensure_ascii=False, indent=2).encode()
+        for size in range(1, 40):
+            self.assertEqual(dict(iter_json_object(self.chunked(data, size))), self.document)
+
+    def test_every_split_point(self):
+        # Two chunks split anywhere, including inside multi-byte characters and numbers
+        data = json.dumps(self.document, ensure_ascii=False).encode()
+        for split in range(len(data) + 1):
+            self.assertEqual(dict(iter_json_object([data[:split], data[split:]])), self.document)
+
+    def test_empty_object(self):
+        self.assertEqual(list(iter_json_object([b' { ', b' } '])), [])
+
+    def test_not_an_object(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_object([b'[1, 2]']))
+
+
+class SyncArmorPiecesTests(TestCase):
+    def setUp(self):
+        self.user = NewUser.objects.create(username='guardian', primary_membership_id='1', membership_type='3')
+
+    def piece(self, item_id, character_id='c1', mobility=10):
+        return {
+            'item_id': item_id, 'character_id': character_id, 'item_hash': 100, 'armor_type': 'HELMET',
+            'is_exotic': False, 'inventory_type': 'character', 'class_type': 'TITAN',
+            **dict.fromkeys(STAT_NAMES, 10), 'mobility': mobility,
+        }
+
+    def test_counts(self):
+        report = sync_armor_pieces(self.user, ['c1', 'c2'], [self.piece('a'), self.piece('b'), self.piece('c', 'c2')])
+        self.assertEqual((report['created'], report['updated'], report['unchanged'], report['deleted']), (3, 0, 0, 0))
+
+        report = sync_armor_pieces(self.user, ['c1'], [self.piece('a'), self.piece('b', mobility=20), self.piece('d')])
+        self.assertEqual((report['created'], report['updated'], report['unchanged'], report['deleted']), (1, 1, 1, 0))
+
+        report = sync_armor_pieces(self.user, ['c1'], [self.piece('b', mobility=20)])
+        self.assertEqual((report['created'], report['updated'], report['unchanged'], report['deleted']), (0, 0, 1, 2))
+
+        # Characters outside the sync keep their pieces
+        self.assertEqual(
+            sorted(ArmorPiece.objects.filter(user=self.user).values_list('character_id', 'item_id', 'mobility')),
+            [('c1', 'b', 20), ('c2', 'c', 10)],
+        )
+
+
+class EnhanceResponseTests(TestCase):
+    def setUp(self):
+        user = NewUser.objects.create(username='guardian', primary_membership_id='1', membership_type='3')
+        for index in range(5):
+            ArmorPiece.objects.create(
+                user=user, item_id=f'piece-{index}', item_hash=str(100 + index), armor_type=ARMOR_SLOTS[index],
+                character_id='c1', class_type='TITAN', inventory_type='character', **dict.fromkeys(STAT_NAMES, 10),
+            )
+        for index in range(5):
+            ArmorModifier.objects.create(item_hash=str(200 + index), name=f'Mod {index}', modifier_type='ARMOR_MOD')
+            ArmorModifier.objects.create(item_hash=str(300 + index), name=f'Fragment {index}', modifier_type='SUBCLASS_FRAGMENT')
+        # Two mods with one name resolve to the higher hash
+        ArmorModifier.objects.create(item_hash='1999', name='mod 0', modifier_type='ARMOR_MOD')
+
+    def claude_response(self, count, **modifier_fields):
+        body = {
+            'armor_pieces': [{'instanceId': f'piece-{index}'} for index in range(count)],
+            'mods': [{'name': f'Mod {index}', **modifier_fields} for index in range(count)],
+            'fragments': [{'name': f'Fragment {index}', **modifier_fields} for index in range(count)],
+            'total_stats': {},
+            'explanation': '',
+        }
+        return f'```json\n{json.dumps(body)}\n```'
+
+    def test_queries_dont_grow_with_the_response(self):
+        view = OptimizeArmor()
+        view.enhance_response(self.claude_response(1))
+        for count in [1, 5]:
+            # Armor pieces, the manifest revision and the modifier names
+            with self.assertNumQueries(3):
+                response = view.enhance_response(self.claude_response(count))
+            self.assertEqual([piece['item_hash'] for piece in response['armor_pieces']], [str(100 + i) for i in range(count)])
+            self.assertEqual([mod['item_hash'] for mod in response['mods']], ['1999'] + [str(200 + i) for i in range(1, count)])
+            self.assertEqual([fragment['item_hash'] for fragment in response['fragments']], [str(300 + i) for i in range(count)])
+
+    def test_known_hashes_are_kept(self):
+        view = OptimizeArmor()
+        view.enhance_response(self.claude_response(1))
+        # Names aren't looked up when every mod and fragment has its hash
+        with self.assertNumQueries(2):
+            response = view.enhance_response(self.claude_response(5, item_hash='42'))
+        self.assertEqual({modifier['item_hash'] for modifier in response['mods'] + response['fragments']}, {'42'})
+
+
+class FakeDownload:
+    def __init__(self, body, fail=False):
+        self.body = body
+        self.fail = fail
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        # Small chunks, and a dropped connection halfway when asked
+        for start in range(0, len(self.body), 7):
+            if self.fail and start >= len(self.body) // 2:
+                raise ConnectionError('connection dropped')
+            yield self.body[start:start + 7]
+
+
+class IngestionTests(TestCase):
+    stat_definitions = {
+        '2996146975': {'displayProperties': {'name': 'Mobility'}},
+        '392767087': {'displayProperties': {'name': 'Resilience'}},
+    }
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_dir = cache_dir.name
+        patcher = override_settings(MANIFEST_CACHE_DIR=self.cache_dir)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+        self.files = {}
+        self.downloads = []
+        self.failing = set()
+        patcher = mock.patch.object(ingest.bungie, 'get', self.fake_get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.publish('v1', mobility=10)
+
+    def items(self, mobility):
+        def investment(stat_hash, value):
+            return {'statTypeHash': stat_hash, 'value': value, 'isConditionallyActive': False}
+
+        return {
+            '1': {
+                'itemType': 2, 'displayProperties': {'name': 'Helm'}, 'inventory': {'tierType': 5},
+                'itemTypeDisplayName': 'Helmet', 'itemSubType': 26, 'itemCategoryHashes': [20, 22, 45],
+            },
+            '2': {
+                'itemType': 19, 'displayProperties': {'name': 'Mobility Mod', 'icon': '/mod.png'}, 'inventory': {'tierType': 2},
+                'itemTypeDisplayName': 'General Armor Mod', 'itemCategoryHashes': [4104513227],
+                'investmentStats': [investment(2996146975, mobility)],
+            },
+            '3': {
+                'itemType': 19, 'displayProperties': {'name': 'Echo of Persistence'}, 'inventory': {'tierType': 2},
+                'itemTypeDisplayName': 'Void Fragment', 'itemCategoryHashes': [1043342778],
+                'investmentStats': [investment(392767087, 10), investment(2996146975, 3)],
+            },
+            '4': {
+                'itemType': 3, 'displayProperties': {'name': 'Hand Cannon'}, 'inventory': {'tierType': 5},
+                'itemTypeDisplayName': 'Hand Cannon', 'itemCategoryHashes': [1, 6],
+            },
+        }
+
+    def publish(self, version, mobility):
+        # A new manifest whose item file changes with its contents, like Bungie's
+        items_path = f'/common/destiny2_content/json/en/DestinyInventoryItemDefinition-{version}.json'
+        stats_path = '/common/destiny2_content/json/en/DestinyStatDefinition-1.json'
+        self.files[items_path] = json.dumps(self.items(mobility)).encode()
+        self.files[stats_path] = json.dumps(self.stat_definitions).encode()
+        self.manifest = {'Response': {'version': version, 'jsonWorldComponentContentPaths': {'en': {
+            'DestinyInventoryItemDefinition': items_path, 'DestinyStatDefinition': stats_path,
+        }}}}
+
+    def fake_get(self, url, endpoint, stream=False):
+        if url == ingest.MANIFEST_URL:
+            return mock.Mock(json=mock.Mock(return_value=self.manifest))
+        path = url.removeprefix('https://www.bungie.net')
+        self.downloads.append(path)
+        return FakeDownload(self.files[path], fail=path in self.failing)
+
+    def ingest(self, force=False):
+        return ingest.run_ingestion([ingest.ArmorDefinitionWriter, ingest.ArmorModifierWriter], force=force)
+
+    def test_ingestion(self):
+        # Both tables come from one download of each file
+        report = self.ingest()
+        self.assertEqual(sorted(self.downloads), sorted(self.files))
+        self.assertEqual(report['tables'], {
+            ARMOR_DEFINITIONS: {'total': 1, 'written': 1}, ARMOR_MODIFIERS: {'total': 2, 'written': 2},
+        })
+        self.assertEqual(
+            list(ArmorDefinition.objects.values_list('item_hash', 'armor_type', 'class_type', 'is_optimizer_candidate')),
+            [('1', 'HELMET', 'TITAN', True)],
+        )
+        self.assertEqual(
+            sorted(ArmorModifier.objects.values_list('item_hash', 'modifier_type', 'subclass', 'mobility', 'resilience')),
+            [('2', 'ARMOR_MOD', '', 10, 0), ('3', 'SUBCLASS_FRAGMENT', 'Void', 0, 10)],
+        )
+        revisions = [get_manifest_revision(ARMOR_DEFINITIONS), get_manifest_revision(ARMOR_MODIFIERS)]
+
+        # Unchanged files are skipped without downloading them
+        self.downloads.clear()
+        report = self.ingest()
+        self.assertEqual(report['skipped'], [ARMOR_DEFINITIONS, ARMOR_MODIFIERS])
+        self.assertEqual(self.downloads, [])
+
+        # --force parses again from the cache, and unchanged rows aren't rewritten
+        out = StringIO()
+        call_command('fill_d2_manifest_tables', force=True, stdout=out)
+        self.assertEqual(self.downloads, [])
+        self.assertIn(f'{ARMOR_DEFINITIONS}: 0 of 1 rows written', out.getvalue())
+        self.assertIn(f'{ARMOR_MODIFIERS}: 0 of 2 rows written', out.getvalue())
+        self.assertEqual([get_manifest_revision(ARMOR_DEFINITIONS), get_manifest_revision(ARMOR_MODIFIERS)], revisions)
+
+        # A new item file only rewrites the rows whose payload changed
+        self.publish('v2', mobility=20)
+        report = self.ingest()
+        self.assertEqual(self.downloads, ['/common/destiny2_content/json/en/DestinyInventoryItemDefinition-v2.json'])
+        self.assertEqual(report['cached_files'], 1)
+        self.assertEqual(report['tables'][ARMOR_DEFINITIONS]['written'], 0)
+        self.assertEqual(report['tables'][ARMOR_MODIFIERS]['written'], 1)
+        self.assertEqual(ArmorModifier.objects.get(item_hash='2').mobility, 20)
+        self.assertEqual(get_manifest_revision(ARMOR_DEFINITIONS), revisions[0])
+        self.assertEqual(get_manifest_revision(ARMOR_MODIFIERS), revisions[1] + 1)
+        # The previous manifest's file was dropped from the cache
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_failed_download_leaves_no_file(self):
+        self.publish('v3', mobility=10)
+        path = self.manifest['Response']['jsonWorldComponentContentPaths']['en']['DestinyInventoryItemDefinition']
+        self.failing.add(path)
+        with self.assertRaises(ConnectionError):
+            ingest.download_definition_file(path)
+        # Neither the partial download nor a truncated file is left behind
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+        self.failing.clear()
+        local_path, size = ingest.download_definition_file(path)
+        self.assertEqual(size, len(self.files[path]))
+        self.assertEqual(ingest.download_definition_file(path), (local_path, 0))
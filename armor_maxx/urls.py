@@ -1,7 +1,13 @@
 # armor_maxx/urls.py
+from django.conf import settings
 from django.urls import path
-from .views import OptimizeArmor
+from .views import OptimizeArmor, CheckStatFeasibility, SweepExotics
+
+if settings.ASYNC_VIEWS:
+    from .async_views import AsyncOptimizeArmor as OptimizeArmor
 
 urlpatterns = [
     path('optimize/', OptimizeArmor.as_view(), name='optimize_armor'),
+    path('optimize/exotics/', SweepExotics.as_view(), name='sweep_exotics'),
+    path('feasibility/', CheckStatFeasibility.as_view(), name='check_stat_feasibility'),
 ]
\ No newline at end of file
@@ -42,6 +42,15 @@ CLASS_CATEGORY_HASHES = {
     'HUNTER': 23, 
 }
 
+STAT_HASH_TO_NAME = {
+    '2996146975': 'mobility',
+    '392767087': 'resilience',
+    '1943323491': 'recovery',
+    '1735777505': 'discipline',
+    '144602215': 'intellect',
+    '4244567218': 'strength',
+}
+
 def get_armor_type(item_category_hashes):
     if not item_category_hashes:
         return None
@@ -57,4 +66,15 @@ def get_item_class(item_category_hashes):
     for class_name, hash_value in CLASS_CATEGORY_HASHES.items():
         if hash_value in item_category_hashes:
             return class_name
-    return 'ALL'  # If no class-specific hash is found, assume it's for all classes
\ No newline at end of file
+    return 'ALL'  # If no class-specific hash is found, assume it's for all classes
+
+# Legendary and Exotic armor that fills one of the five armor slots
+OPTIMIZER_TIER_TYPES = (5, 6)
+
+def get_definition_columns(item_category_hashes, tier_type):
+    armor_type = get_armor_type(item_category_hashes)
+    return {
+        'armor_type': armor_type or '',
+        'class_type': get_item_class(item_category_hashes or []),
+        'is_optimizer_candidate': bool(armor_type) and tier_type in OPTIMIZER_TIER_TYPES,
+    }
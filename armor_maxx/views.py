@@ -1,86 +1,297 @@
 import re
 import json
+import time
 import logging
 import requests
+from collections import namedtuple
 from django.conf import settings
 from users.models import NewUser
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from users.views import refresh_bungie_token
-from armor_maxx.models import ArmorDefinition
+from users.profiles import get_profile
 from django.core.exceptions import ObjectDoesNotExist
 from anthropic import Anthropic, HUMAN_PROMPT, AI_PROMPT
-from .models import ArmorDefinition, ArmorPiece, ArmorModifier, ArmorOptimizationRequest
-from .utils import get_element_from_subclass, SUBCLASS_TO_ELEMENT_MAP, get_armor_type, get_item_class
+from .models import ArmorPiece, ArmorModifier, ArmorOptimizationRequest
+from .utils import get_element_from_subclass, SUBCLASS_TO_ELEMENT_MAP, STAT_HASH_TO_NAME
+from .optimizer import (
+    ARMOR_SLOT_NAMES, ARMOR_SLOTS, MAX_TOTAL_TIERS, STAT_NAMES, build_exotic_candidates, build_slot_matrices,
+    find_top_loadouts, get_score_rules, prune_below_minimums, prune_dominated, prune_sweep_below_minimums, rank_totals,
+    restrict_candidates, summarize_totals, sweep_exotics,
+)
+from .bonus_tables import base_score_rules, best_bonus, get_bonus_table
+from .feasibility import check_variants, exotic_variants, max_reachable_tiers
+from .sync import sync_armor_pieces
+from .definitions import get_definition_index
 
 logger = logging.getLogger(__name__)
 
+MAX_RESULT_COUNT = 20
+MAX_TIERS = 10 * len(STAT_NAMES)
+SYNC_COMPONENTS = [102, 200, 201, 205, 304]
+FEASIBILITY_DEADLINE_MS = 250
+# Keys accepted for {slot: instanceId} locks, e.g. "CHEST_ARMOR" or "Chest Armor"
+LOCK_SLOT_KEYS = {key: slot for slot, name in ARMOR_SLOT_NAMES.items() for key in (slot, name.upper())}
+
+
+def parse_number(value, name, kind=int):
+    # int()/float() with an error message naming the request field
+    try:
+        if isinstance(value, bool):
+            raise TypeError
+        return kind(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"{name} must be {'an integer' if kind is int else 'a number'}")
+
+
+def parse_stat_tiers(stat_tiers, default):
+    # {stat hash or name: tier} -> one tier per stat in STAT_NAMES order
+    if not isinstance(stat_tiers, dict):
+        raise ValueError('Stat tiers must be an object')
+    tiers = [default] * len(STAT_NAMES)
+    for stat, tier in stat_tiers.items():
+        name = STAT_HASH_TO_NAME.get(str(stat), stat)
+        if name not in STAT_NAMES:
+            raise ValueError(f'Unknown stat: {stat}')
+        tiers[STAT_NAMES.index(name)] = max(0, min(parse_number(tier, f'{name} tier'), 10))
+    return tiers
+
+
+def parse_constraints(constraints):
+    constraints = constraints or {}
+    if not isinstance(constraints, dict):
+        raise ValueError('constraints must be an object')
+    # Locked items may come as a list of instance IDs or as {slot: instanceId};
+    # either way they become {instanceId: slot or None} for restrict_candidates
+    locked_items = constraints.get('lockedItems') or []
+    if isinstance(locked_items, dict):
+        locked_ids = {}
+        for key, item_id in locked_items.items():
+            slot = LOCK_SLOT_KEYS.get(str(key).upper())
+            if slot is None:
+                raise ValueError(f'Unknown armor slot: {key}')
+            if slot in locked_ids.values():
+                raise ValueError(f'Only one locked item per slot: {ARMOR_SLOT_NAMES[slot]}')
+            locked_ids[str(item_id)] = slot
+    elif isinstance(locked_items, list):
+        locked_ids = dict.fromkeys(str(item_id) for item_id in locked_items)
+    else:
+        raise ValueError('lockedItems must be a list or an object')
+    excluded_items = constraints.get('excludedItems') or []
+    if not isinstance(excluded_items, list):
+        raise ValueError('excludedItems must be a list')
+    excluded_ids = [str(item_id) for item_id in excluded_items]
+    min_tiers = parse_stat_tiers(constraints.get('minTiers') or {}, 0)
+    max_tiers = parse_stat_tiers(constraints.get('maxTiers') or {}, 10)
+    if any(low > high for low, high in zip(min_tiers, max_tiers)):
+        raise ValueError('minTiers can not exceed maxTiers')
+    max_total_tiers = parse_number(constraints.get('maxTotalTiers', MAX_TOTAL_TIERS), 'maxTotalTiers')
+    max_total_tiers = max(0, min(max_total_tiers, MAX_TIERS))
+    return locked_ids, excluded_ids, min_tiers, max_tiers, max_total_tiers
+
+
+# One optimize request body, see read_optimize_request
+OptimizeRequest = namedtuple('OptimizeRequest', [
+    'username', 'exotic_id', 'exotic_hash', 'subclass_id', 'stat_priorities', 'chat_input', 'character_id',
+    'masterwork_tolerance', 'deadline_ms', 'result_count', 'locked_ids', 'excluded_ids', 'min_tiers', 'max_tiers',
+    'max_total_tiers',
+])
+
+
+def read_optimize_request(data):
+    # Raises ValueError with a message for the client for malformed numbers or constraints
+    deadline_ms = data.get('deadlineMs')
+    exotic = data.get('exoticId') or {}
+    if not isinstance(exotic, dict):
+        raise ValueError('exoticId must be an object')
+    return OptimizeRequest(
+        data.get('username'),
+        exotic.get('instanceId'),
+        exotic.get('itemHash'),
+        data.get('subclass'),
+        data.get('statPriorities', []),
+        data.get('chatInput'),
+        data.get('characterId'),
+        parse_number(data.get('masterworkTolerance', 0), 'masterworkTolerance'),
+        parse_number(deadline_ms, 'deadlineMs', float) if deadline_ms is not None else None,
+        max(1, min(parse_number(data.get('resultCount', 1), 'resultCount'), MAX_RESULT_COUNT)),
+        *parse_constraints(data.get('constraints')),
+    )
+
+
 class OptimizeArmor(APIView):
     def post(self, request, *args, **kwargs):
-        username = request.data.get('username')
-        exotic_id = request.data.get('exoticId', {}).get('instanceId')
-        exotic_hash = request.data.get('exoticId', {}).get('itemHash')
-        subclass_id = request.data.get('subclass')
-        stat_priorities = request.data.get('statPriorities', [])
-        chat_input = request.data.get('chatInput')
-        character_id = request.data.get('characterId')
+        try:
+            params = read_optimize_request(request.data)
+        except (TypeError, ValueError) as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            user = NewUser.objects.get(username=username)
+            user = NewUser.objects.get(username=params.username)
         except NewUser.DoesNotExist:
             return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
 
         # Check if this is a chat-only request
-        if not exotic_id and not subclass_id:
-            return self.handle_chat(user, chat_input)
-
-        # Get the element type from the subclass ID
-        element_type = get_element_from_subclass(subclass_id)
+        if not params.exotic_id and not params.subclass_id:
+            return self.handle_chat(user, params.chat_input)
 
          # Sync armor data
         try:
-            armor_count = self.sync_armor_data(user, character_id, exotic_id)
+            armor_count = self.sync_armor_data(user, params.character_id, params.exotic_id)
         except Exception as e:
             return Response({'error': 'Error syncing armor data'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # Fetch armor pieces, fragments, and mods
-        armor_pieces = ArmorPiece.objects.filter(user=user, character_id=character_id)
-        fragments = ArmorModifier.objects.filter(modifier_type='SUBCLASS_FRAGMENT', subclass=element_type)
-        armor_mods = ArmorModifier.objects.filter(modifier_type='ARMOR_MOD')
+        loadout, error = self.choose_loadout(user, params)
+        if error:
+            return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Call Claude API
+        prompt = self.build_prompt(user, params, loadout)
+        response = self.call_claude_api(prompt)
+        claude_response = response.content[0].text
+        logger.info(f"Claude's response details: {claude_response}")
+
+        enhanced_response = self.finish_optimization(user, params, claude_response, loadout)
+        if enhanced_response is None:
+            return Response({'error': 'Failed to parse optimization suggestion'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return Response(enhanced_response)
+
+    def choose_loadout(self, user, params):
+        # Returns (loadout, None), or (None, error message) when the constraints can't be met
+        armor_pieces = ArmorPiece.objects.filter(user=user, character_id=params.character_id)
+
+        # Get the element type from the subclass ID
+        element_type = get_element_from_subclass(params.subclass_id)
+
+        # Pick the armor set, fragments and mods with the native solver; Claude only explains it.
+        # Constraints shrink the candidate lists before any combination is formed.
+        rules = get_score_rules(params.stat_priorities, params.max_total_tiers, params.min_tiers, params.max_tiers)
+        bonus_table = get_bonus_table(element_type)
+        base_rules = base_score_rules(rules, bonus_table)
+
+        slot_candidates, exotic_slot = build_slot_matrices(armor_pieces, params.exotic_id)
+        # A stale ID or an exotic of another class would silently give an all-legendary set
+        if params.exotic_id and exotic_slot is None:
+            return None, 'Exotic not found'
+        slot_candidates, missing_ids = restrict_candidates(slot_candidates, params.locked_ids, params.excluded_ids)
+        if missing_ids:
+            return None, f"Locked items not found in their slot: {', '.join(missing_ids)}"
+        pruned_count = 0
+        if base_rules.min_totals is not None:
+            slot_candidates, pruned_count = prune_below_minimums(slot_candidates, base_rules.min_totals)
+            logger.info(f"Pruned {pruned_count} armor pieces below the minimum tiers")
+        ignored_stats = [index for index, tier in enumerate(params.max_tiers) if tier == 0]
+        slot_candidates, dominated_count = prune_dominated(
+            slot_candidates, params.masterwork_tolerance, ignored_stats, params.result_count,
+        )
+        pruned_count += dominated_count
+        logger.info(f"Pruned {dominated_count} dominated armor pieces")
+
+        # base_rules only let through armor that some fragment/mod combination
+        # lifts to the minimum tiers
+        search = find_top_loadouts(
+            slot_candidates, base_rules, params.result_count,
+            deadline_ms=params.deadline_ms,
+            processes=settings.ARMOR_OPTIMIZER_PROCESSES,
+        )
+        if search is not None and not search['loadouts'] and not search['optimal']:
+            return None, 'No valid armor combination found within the deadline'
+        if search is None or not search['loadouts']:
+            return None, 'No valid armor combination found for the selected exotic and constraints'
+        logger.info(f"Optimizer scored {search['explored']} of {search['combinations']} combinations (optimal: {search['optimal']})")
+
+        # Fragments and mods can reorder the candidates, so rank them on their final stats.
+        # The search ranks base armor stats only: its optimality holds for those,
+        # and a set outside the top result_count could still end higher with bonuses.
+        loadouts = [self.apply_bonus(loadout, bonus_table, rules) for loadout in search['loadouts']]
+        loadouts = [loadout for loadout in loadouts if loadout is not None]
+        if not loadouts:
+            return None, 'No fragments and mods reach the minimum tiers'
+        loadouts.sort(key=lambda loadout: rank_totals(
+            [loadout['final']['total_stats'][stat] for stat in STAT_NAMES], rules
+        ), reverse=True)
+        loadouts = loadouts[:params.result_count]
+
+        loadout = loadouts[0]
+        loadout['pruned'] = pruned_count
+        loadout['base_stats_optimal'] = search['optimal']
+        loadout['ranked'] = [self.format_loadout(candidate) for candidate in loadouts]
+        return loadout, None
+
+    def build_prompt(self, user, params, loadout):
+        chosen_ids = [piece['instanceId'] for piece in loadout['armor_pieces']]
+        chosen_pieces = ArmorPiece.objects.filter(user=user, character_id=params.character_id, item_id__in=chosen_ids)
+        chosen_hashes = {modifier['item_hash'] for modifier in loadout['fragments'] + loadout['mods']}
+        chosen_modifiers = ArmorModifier.objects.filter(item_hash__in=chosen_hashes)
+        fragments = chosen_modifiers.filter(modifier_type='SUBCLASS_FRAGMENT')
+        armor_mods = chosen_modifiers.filter(modifier_type='ARMOR_MOD')
 
         # Prepare data for Claude
         armor_data, fragment_data, armor_mod_data = self.prepare_data_for_claude(
-            armor_pieces, fragments, armor_mods, exotic_id, exotic_hash, stat_priorities
+            chosen_pieces, fragments, armor_mods, params.exotic_id, params.exotic_hash, params.stat_priorities
         )
 
         # Prepare prompt for Claude
-        prompt = self.prepare_claude_prompt(armor_data, fragment_data, armor_mod_data, exotic_id, stat_priorities, chat_input, subclass_id)
-
-        # Call Claude API
-        response = self.call_claude_api(prompt)
-        claude_response = response.content[0].text
-        logger.info(f"Claude's response details: {claude_response}")
+        return self.prepare_claude_prompt(
+            armor_data, fragment_data, armor_mod_data, params.exotic_id, params.stat_priorities, params.chat_input,
+            params.subclass_id, loadout,
+        )
 
+    def finish_optimization(self, user, params, claude_response, loadout):
         # Parse and enhance Claude's response
-        enhanced_response = self.enhance_response(claude_response)
+        enhanced_response = self.enhance_response(claude_response, loadout)
         logger.info(f"Enhanced response: {enhanced_response}")
 
         if enhanced_response is None:
-            return Response({'error': 'Failed to parse optimization suggestion'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            return None
 
         # Save the optimization request and result
         ArmorOptimizationRequest.objects.create(
             user=user,
-            exotic_id=exotic_id,
-            subclass=subclass_id,
-            character_id=character_id,
+            exotic_id=params.exotic_id,
+            subclass=params.subclass_id,
+            character_id=params.character_id,
             result=json.dumps(enhanced_response)  # Store the enhanced response as JSON string
         )
+        return enhanced_response
 
-        return Response(enhanced_response)  
+    def apply_bonus(self, loadout, bonus_table, rules):
+        base_totals = [loadout['total_stats'][stat] for stat in STAT_NAMES]
+        bonus = best_bonus(bonus_table, base_totals, rules)
+        if bonus is None:
+            return None
+        loadout['fragments'], loadout['mods'], final_totals = bonus
+        loadout['final'] = summarize_totals(final_totals)
+        return loadout
+
+    def format_loadout(self, loadout):
+        return {
+            'armor_pieces': loadout['armor_pieces'],
+            'fragments': loadout['fragments'],
+            'mods': loadout['mods'],
+            'base_stats': loadout['total_stats'],
+            **loadout['final'],
+        }
 
-    def enhance_response(self, claude_response):
+    def find_modifier_hashes(self, modifiers):
+        # {(modifier_type, case-folded name): item_hash} in one query, only
+        # needed when a mod or fragment came back without an item_hash. Names
+        # aren't unique, so a clash resolves to the highest item_hash.
+        if all(modifier.get('item_hash') for modifier in modifiers):
+            return {}
+        modifier_hashes = {}
+        for name, modifier_type, item_hash in ArmorModifier.objects.filter(
+            modifier_type__in=['ARMOR_MOD', 'SUBCLASS_FRAGMENT']
+        ).values_list('name', 'modifier_type', 'item_hash'):
+            key = (modifier_type, name.casefold())
+            if key in modifier_hashes:
+                logger.warning(f"Several {modifier_type} named {name}: {modifier_hashes[key]}, {item_hash}")
+                item_hash = max(modifier_hashes[key], item_hash, key=int)
+            modifier_hashes[key] = item_hash
+        return modifier_hashes
+
+    def enhance_response(self, claude_response, loadout=None):
         logger.info("Starting to enhance Claude's response")
         logger.debug(f"Claude's full response: {claude_response}")
 
@@ -108,40 +319,46 @@ class OptimizeArmor(APIView):
                 if key not in enhanced_response:
                     logger.error(f"Missing required key in response: {key}")
                     raise ValueError(f"Missing required key in response: {key}")
+
+            # The solver's armor choice is authoritative, whatever Claude echoed back
+            if loadout is not None:
+                enhanced_response['armor_pieces'] = [dict(piece) for piece in loadout['armor_pieces']]
+                enhanced_response['base_stats'] = loadout['total_stats']
+                enhanced_response['base_tiers'] = loadout['total_tiers']
+                enhanced_response['pruned_pieces'] = loadout['pruned']
+                enhanced_response['base_stats_optimal'] = loadout['base_stats_optimal']
+                enhanced_response['fragments'] = [dict(fragment) for fragment in loadout['fragments']]
+                enhanced_response['mods'] = [dict(mod) for mod in loadout['mods']]
+                enhanced_response['total_stats'] = loadout['final']['total_stats']
+                enhanced_response['total_tiers'] = loadout['final']['total_tiers']
+                enhanced_response['loadouts'] = loadout['ranked']
             
+            # Resolve every returned piece, mod and fragment with one query each
+            instance_ids = [armor_piece['instanceId'] for armor_piece in enhanced_response['armor_pieces']]
+            piece_hashes = dict(ArmorPiece.objects.filter(item_id__in=instance_ids).values_list('item_id', 'item_hash'))
+            definitions = get_definition_index()
+            modifier_hashes = self.find_modifier_hashes(enhanced_response['mods'] + enhanced_response['fragments'])
+
             # Add item_hash to armor pieces
             for armor_piece in enhanced_response['armor_pieces']:
                 instance_id = armor_piece['instanceId']
-                try:
-                    db_armor_piece = ArmorPiece.objects.get(item_id=instance_id)
-                    armor_piece['item_hash'] = db_armor_piece.item_hash
-                    
-                    try:
-                        armor_def = ArmorDefinition.objects.get(item_hash=db_armor_piece.item_hash)
-                        armor_piece['name'] = armor_def.name
-                    except ArmorDefinition.DoesNotExist:
-                        logger.warning(f"ArmorDefinition not found for item_hash: {db_armor_piece.item_hash}")
-                except ArmorPiece.DoesNotExist:
+                item_hash = piece_hashes.get(instance_id)
+                armor_piece['item_hash'] = item_hash
+                if item_hash is None:
                     logger.error(f"ArmorPiece not found for instance_id: {instance_id}")
-                    armor_piece['item_hash'] = None
-
-            # Add item_hash to mods
-            for mod in enhanced_response['mods']:
-                try:
-                    db_mod = ArmorModifier.objects.get(name__iexact=mod['name'], modifier_type='ARMOR_MOD')
-                    mod['item_hash'] = db_mod.item_hash
-                except ArmorModifier.DoesNotExist:
-                    logger.warning(f"ArmorModifier not found for mod: {mod['name']}")
-                    mod['item_hash'] = None
-
-            # Add item_hash to fragments
-            for fragment in enhanced_response['fragments']:
-                try:
-                    db_fragment = ArmorModifier.objects.get(name__iexact=fragment['name'], modifier_type='SUBCLASS_FRAGMENT')
-                    fragment['item_hash'] = db_fragment.item_hash
-                except ArmorModifier.DoesNotExist:
-                    logger.warning(f"ArmorModifier not found for fragment: {fragment['name']}")
-                    fragment['item_hash'] = None
+                elif item_hash in definitions:
+                    armor_piece['name'] = definitions[item_hash].name
+                else:
+                    logger.warning(f"ArmorDefinition not found for item_hash: {item_hash}")
+
+            # Add item_hash to mods and fragments that don't carry the solver's one
+            for key, modifier_type, label in [('mods', 'ARMOR_MOD', 'mod'), ('fragments', 'SUBCLASS_FRAGMENT', 'fragment')]:
+                for modifier in enhanced_response[key]:
+                    if modifier.get('item_hash'):
+                        continue
+                    modifier['item_hash'] = modifier_hashes.get((modifier_type, modifier['name'].casefold()))
+                    if modifier['item_hash'] is None:
+                        logger.warning(f"ArmorModifier not found for {label}: {modifier['name']}")
 
             logger.info("Response structure validation passed")
             logger.debug(f"Final enhanced response: {enhanced_response}")
@@ -226,81 +443,91 @@ class OptimizeArmor(APIView):
         except ArmorPiece.DoesNotExist:
             return None  # or a default value, or raise an exception
 
+    def chat_prompt(self, chat_input):
+        return f"{HUMAN_PROMPT} As a Destiny 2 expert, please respond to the following question or comment: {chat_input}\n\n{AI_PROMPT}"
+
     def handle_chat(self, user, chat_input):
-        prompt = f"{HUMAN_PROMPT} As a Destiny 2 expert, please respond to the following question or comment: {chat_input}\n\n{AI_PROMPT}"
+        prompt = self.chat_prompt(chat_input)
         try:
             response = self.call_claude_api(prompt)
             return Response({'response': response.completion})
         except Exception as e:
             return Response({'error': 'Error processing chat request'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    def sync_armor_data(self, user, character_id, chosen_exotic_id):
-        try:
-            access_token = refresh_bungie_token(user.username)
-        except Exception as e:
-            raise Exception(f"Failed to refresh token: {str(e)}")
+    def sync_armor_data(self, user, character_id, chosen_exotic_id, include_exotics=False):
+        data = self.fetch_profile(user)
+        return self.save_character_armor(user, data, character_id, chosen_exotic_id, include_exotics)
 
-        headers = {
-            'X-API-Key': settings.SOCIAL_AUTH_BUNGIE_API_KEY,
-            'Authorization': f'Bearer {access_token}',
-        }
+    def save_character_armor(self, user, data, character_id, chosen_exotic_id, include_exotics=False):
+        if character_id not in data['characters']['data']:
+            raise KeyError(f"Character ID {character_id} not found in API response")
+        return self.save_armor_data(user, data, [character_id], chosen_exotic_id, include_exotics)[character_id]
 
-        url = f"https://www.bungie.net/Platform/Destiny2/{user.membership_type}/Profile/{user.primary_membership_id}/?components=102,200,201,205,304"
-        
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            data = response.json()['Response']
-        except requests.RequestException as e:
-            raise
+    def sync_all_characters(self, user, include_exotics=True):
+        # One profile fetch covers every character; returns {character_id: armor count}
+        data = self.fetch_profile(user)
+        return self.save_armor_data(user, data, list(data['characters']['data']), None, include_exotics)
+
+    def fetch_profile(self, user):
+        # Shares the fetch with a concurrent bungie/get/ for the same profile
+        return self.check_profile(*get_profile(user, SYNC_COMPONENTS))
+
+    def check_profile(self, status_code, response_data):
+        if status_code != 200:
+            raise requests.HTTPError(f"Profile request failed with status {status_code}")
+        data = response_data['Response']
 
         if 'characters' not in data:
             raise KeyError("'characters' key not found in API response")
+        return data
 
-        if character_id not in data['characters']['data']:
-            raise KeyError(f"Character ID {character_id} not found in API response")
-
+    def save_armor_data(self, user, data, character_ids, chosen_exotic_id, include_exotics=False):
+        started = time.monotonic()
         armor_pieces = []
 
-        def process_armor(item, inventory_type):
+        definitions = get_definition_index()
+        character_classes = {
+            character_id: ['TITAN', 'HUNTER', 'WARLOCK'][data['characters']['data'][character_id]['classType']]
+            for character_id in character_ids
+        }
+
+        def process_armor(item, inventory_type, owners):
             item_hash = item['itemHash']
             item_instance_id = item.get('itemInstanceId')
             
             if not item_instance_id or item_instance_id not in data['itemComponents']['stats']['data']:
                 return
 
-            try:
-                armor_def = ArmorDefinition.objects.get(item_hash=str(item_hash))
-            except ArmorDefinition.DoesNotExist:
+            armor_def = definitions.get(str(item_hash))
+            if armor_def is None:
                 return
 
             item_stats = data['itemComponents']['stats']['data'][item_instance_id]['stats']
             
-            armor_type = get_armor_type(armor_def.item_category_hashes)
+            armor_type = armor_def.armor_type
             if not armor_type:
                 return
 
-            item_class = get_item_class(armor_def.item_category_hashes)
+            item_class = armor_def.class_type
             is_exotic = armor_def.tier_type == 6
 
-            # Check if the armor is suitable for the current character
-            character_class_type = data['characters']['data'][character_id]['classType']
-            character_class = ['TITAN', 'HUNTER', 'WARLOCK'][character_class_type]
-            
-            if item_class not in [character_class, 'ALL']:
-                 return
-
-            # Process only Legendary armor and the chosen Exotic
-            if armor_def.tier_type == 5 or (is_exotic and item_instance_id == chosen_exotic_id):
-                stats = {
-                    'mobility': item_stats.get('2996146975', {}).get('value', 0),
-                    'resilience': item_stats.get('392767087', {}).get('value', 0),
-                    'recovery': item_stats.get('1943323491', {}).get('value', 0),
-                    'discipline': item_stats.get('1735777505', {}).get('value', 0),
-                    'intellect': item_stats.get('144602215', {}).get('value', 0),
-                    'strength': item_stats.get('4244567218', {}).get('value', 0)
-                }
-                
+            # Process only Legendary armor and the chosen Exotic (or every Exotic for a sweep)
+            if not (armor_def.tier_type == 5 or (is_exotic and (include_exotics or item_instance_id == chosen_exotic_id))):
+                return
+
+            stats = {
+                'mobility': item_stats.get('2996146975', {}).get('value', 0),
+                'resilience': item_stats.get('392767087', {}).get('value', 0),
+                'recovery': item_stats.get('1943323491', {}).get('value', 0),
+                'discipline': item_stats.get('1735777505', {}).get('value', 0),
+                'intellect': item_stats.get('144602215', {}).get('value', 0),
+                'strength': item_stats.get('4244567218', {}).get('value', 0)
+            }
+
+            # Check if the armor is suitable for each character
+            for character_id in owners:
+                if item_class not in [character_classes[character_id], 'ALL']:
+                    continue
                 armor_pieces.append({
                     'item_id': item_instance_id,
                     'item_hash': item_hash,
@@ -311,49 +538,31 @@ class OptimizeArmor(APIView):
                     'class_type': item_class,
                     **stats
                 })
-                
-        # Process all inventories (corrected indentation)
-        for inventory_type, inventory_data in [
-            ('profile', data['profileInventory']['data']['items']),
-            ('character', data['characterInventories']['data'][character_id]['items']),
-            ('equipped', data['characterEquipment']['data'][character_id]['items'])
-        ]:
-            for item in inventory_data:
-                process_armor(item, inventory_type)
-
-        # Update or create ArmorPiece objects in the database
-        saved_count = 0
-        for armor in armor_pieces:
-            try:
-                if not armor['armor_type']:
-                    continue
 
-                ArmorPiece.objects.update_or_create(
-                    user=user,
-                    item_id=armor['item_id'],
-                    character_id=character_id,
-                    defaults={
-                        'item_hash': armor['item_hash'],
-                        'armor_type': armor['armor_type'],
-                        'is_exotic': armor['is_exotic'],
-                        'inventory_type': armor['inventory_type'],
-                        'class_type': armor['class_type'],
-                        'mobility': armor['mobility'],
-                        'resilience': armor['resilience'],
-                        'recovery': armor['recovery'],
-                        'discipline': armor['discipline'],
-                        'intellect': armor['intellect'],
-                        'strength': armor['strength']
-                    }
-                )
-                saved_count += 1
-            except Exception as e:
-                logger.error(f"Error saving armor piece {armor['item_id']}: {str(e)}")
-
-        # Remove old armor pieces that are no longer in the inventory
-        current_item_ids = [armor['item_id'] for armor in armor_pieces]
-        deleted_count, _ = ArmorPiece.objects.filter(user=user, character_id=character_id).exclude(item_id__in=current_item_ids).delete()
-        return len(armor_pieces)
+        # The vault is shared by every character, their own inventories are not
+        for item in data['profileInventory']['data']['items']:
+            process_armor(item, 'profile', character_ids)
+        for character_id in character_ids:
+            for inventory_type, inventory_data in [
+                ('character', data['characterInventories']['data'][character_id]['items']),
+                ('equipped', data['characterEquipment']['data'][character_id]['items'])
+            ]:
+                for item in inventory_data:
+                    process_armor(item, inventory_type, [character_id])
+
+        parse_ms = round((time.monotonic() - started) * 1000, 1)
+
+        report = sync_armor_pieces(user, character_ids, armor_pieces)
+        logger.info(
+            f"Armor sync for {len(character_ids)} characters: {report['created']} created, {report['updated']} updated, "
+            f"{report['unchanged']} unchanged, {report['deleted']} deleted "
+            f"(parse {parse_ms} ms, load {report['timings']['load']} ms, diff {report['timings']['diff']} ms, write {report['timings']['write']} ms)"
+        )
+
+        counts = {character_id: 0 for character_id in character_ids}
+        for armor in armor_pieces:
+            counts[armor['character_id']] += 1
+        return counts
 
     def prepare_data_for_claude(self, armor_pieces, fragments, armor_mods, exotic_id, exotic_hash, stat_priorities):
         armor_data = [
@@ -403,19 +612,12 @@ class OptimizeArmor(APIView):
 
         return armor_data, fragment_data, armor_mod_data
 
-    def prepare_claude_prompt(self, armor_data, fragment_data, armor_mod_data, exotic_id, stat_priorities, chat_input, subclass_id):
-        stat_names = {
-            '2996146975': 'mobility',
-            '392767087': 'resilience',
-            '1943323491': 'recovery',
-            '1735777505': 'discipline',
-            '144602215': 'intellect',
-            '4244567218': 'strength'
-        }
-        priority_names = [stat_names.get(stat, stat) for stat in stat_priorities]
+    def prepare_claude_prompt(self, armor_data, fragment_data, armor_mod_data, exotic_id, stat_priorities, chat_input, subclass_id, loadout=None):
+        priority_names = [STAT_HASH_TO_NAME.get(stat, stat) for stat in stat_priorities]
         subclass_name = SUBCLASS_TO_ELEMENT_MAP.get(subclass_id, "Unknown Subclass")
         
         prompt = f'''{HUMAN_PROMPT} As a Destiny 2 armor optimization expert and grumpy sweeper robot, please analyze the following armor pieces, subclass fragments, and armor mods to suggest the best loadout for maximizing overall stats. The player is using the {subclass_name} subclass and must use the exotic armor piece with ID {exotic_id}. The stat priorities are (in order): {', '.join(priority_names)}. Here's the data:
+        {self.prepare_loadout_note(loadout)}
 
         Armor Pieces: {json.dumps(armor_data, indent=2)}
 
@@ -494,13 +696,172 @@ class OptimizeArmor(APIView):
         {AI_PROMPT}'''
         return prompt
 
-    def call_claude_api(self, prompt):
-        anthropic = Anthropic(api_key=settings.ANTHROPIC_API_KEY)
-        return anthropic.messages.create(
+    def prepare_loadout_note(self, loadout):
+        if loadout is None:
+            return ''
+        return f'''
+        The armor pieces, fragments and mods below have already been chosen by our optimizer and must be used exactly as given.
+        Their combined base stats are {json.dumps(loadout['total_stats'])} ({loadout['total_tiers']} tiers, {loadout['wasted']} wasted points).
+        Fragments: {json.dumps(loadout['fragments'])}
+        Mods: {json.dumps(loadout['mods'])}
+        Final stats with fragments and mods: {json.dumps(loadout['final']['total_stats'])} ({loadout['final']['total_tiers']} tiers).
+        Echo these choices in your JSON and explain why the build works.
+        '''
+
+    def claude_request(self, prompt):
+        return dict(
             model="claude-3-haiku-20240307",
             max_tokens=1000,
             messages=[
                 {"role": "user", "content": prompt}
             ]
         )
-   
\ No newline at end of file
+
+    def call_claude_api(self, prompt):
+        anthropic = Anthropic(api_key=settings.ANTHROPIC_API_KEY)
+        return anthropic.messages.create(**self.claude_request(prompt))
+   
+
+
+class CheckStatFeasibility(APIView):
+    # Answers "can I reach these tiers?" from the already synced armor, without Claude
+    def post(self, request, *args, **kwargs):
+        username = request.data.get('username')
+        character_id = request.data.get('characterId')
+        exotic = request.data.get('exoticId') or {}
+        subclass_id = request.data.get('subclass')
+        min_tiers = request.data.get('minTiers', {})
+
+        if not isinstance(exotic, dict):
+            return Response({'error': 'exoticId must be an object'}, status=status.HTTP_400_BAD_REQUEST)
+        exotic_id = exotic.get('instanceId')
+        if not isinstance(min_tiers, dict):
+            return Response({'error': 'minTiers must be an object'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            targets = parse_stat_tiers(min_tiers, 0)
+        except (TypeError, ValueError) as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            user = NewUser.objects.get(username=username)
+        except NewUser.DoesNotExist:
+            return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        armor_pieces = ArmorPiece.objects.filter(user=user, character_id=character_id)
+        slot_candidates, exotic_slot = build_slot_matrices(armor_pieces, exotic_id)
+        if exotic_id and exotic_slot is None:
+            return Response({'error': 'Exotic not found'}, status=status.HTTP_400_BAD_REQUEST)
+        # Without a chosen exotic any one of the synced exotics may be worn
+        variants = [slot_candidates] if exotic_id else exotic_variants(slot_candidates, build_exotic_candidates(armor_pieces))
+        variants = [candidates for candidates in variants if all(len(candidates[slot].ids) for slot in ARMOR_SLOTS)]
+        if not variants:
+            return Response({'error': 'No synced armor for every slot'}, status=status.HTTP_400_BAD_REQUEST)
+
+        bonus_table = get_bonus_table(get_element_from_subclass(subclass_id))
+        result = check_variants(variants, bonus_table, targets, FEASIBILITY_DEADLINE_MS)
+        max_tiers = [max(tiers) for tiers in zip(*(max_reachable_tiers(candidates, bonus_table).tolist() for candidates in variants))]
+
+        return Response({
+            # feasible is only known when the check finished before the deadline
+            'feasible': None if result['timed_out'] else result['feasible'],
+            'timedOut': result['timed_out'],
+            'max_tiers': dict(zip(STAT_NAMES, max_tiers)),
+            'loadout': result['loadout'],
+        })
+
+
+class SweepExotics(OptimizeArmor):
+    # Optimizes every exotic the character owns after a single sync, without Claude.
+    # With allCharacters every character is synced from the same profile fetch.
+    def post(self, request, *args, **kwargs):
+        try:
+            params = read_optimize_request(request.data)
+        except (TypeError, ValueError) as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        all_characters = bool(request.data.get('allCharacters', False))
+        if not all_characters and not params.character_id:
+            return Response({'error': 'characterId is required unless allCharacters is set'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            user = NewUser.objects.get(username=params.username)
+        except NewUser.DoesNotExist:
+            return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            if all_characters:
+                character_ids = list(self.sync_all_characters(user, include_exotics=True))
+            else:
+                self.sync_armor_data(user, params.character_id, None, include_exotics=True)
+                character_ids = [params.character_id]
+        except Exception as e:
+            logger.error(f"Error syncing armor data: {str(e)}")
+            return Response({'error': 'Error syncing armor data'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        rules = get_score_rules(params.stat_priorities, params.max_total_tiers, params.min_tiers, params.max_tiers)
+        bonus_table = get_bonus_table(get_element_from_subclass(params.subclass_id))
+
+        results = {}
+        for sweep_character_id in character_ids:
+            armor_pieces = ArmorPiece.objects.filter(user=user, character_id=sweep_character_id)
+            result, missing_ids = self.sweep_character(armor_pieces, bonus_table, rules, params)
+            # Across characters a locked piece only binds the class that can wear it
+            if missing_ids and not all_characters:
+                return Response({'error': f"Locked items not found in their slot: {', '.join(missing_ids)}"}, status=status.HTTP_400_BAD_REQUEST)
+            results[sweep_character_id] = result
+
+        if all_characters:
+            return Response({'characters': results})
+        return Response(results[params.character_id])
+
+    def sweep_character(self, armor_pieces, bonus_table, rules, params):
+        # Legendary candidates are restricted and pruned once for the whole sweep
+        base_rules = base_score_rules(rules, bonus_table)
+        legendary_candidates, _ = build_slot_matrices(armor_pieces, None)
+        legendary_candidates, missing_ids = restrict_candidates(legendary_candidates, params.locked_ids, params.excluded_ids)
+        exotic_candidates, _ = restrict_candidates(build_exotic_candidates(armor_pieces), (), params.excluded_ids)
+        below_count = 0
+        if base_rules.min_totals is not None:
+            legendary_candidates, exotic_candidates, below_count = prune_sweep_below_minimums(
+                legendary_candidates, exotic_candidates, base_rules.min_totals,
+            )
+            logger.info(f"Pruned {below_count} armor pieces below the minimum tiers")
+        ignored_stats = [index for index, tier in enumerate(params.max_tiers) if tier == 0]
+        legendary_candidates, pruned_count = prune_dominated(legendary_candidates, params.masterwork_tolerance, ignored_stats)
+        pruned_count += below_count
+
+        sweep = sweep_exotics(legendary_candidates, exotic_candidates, base_rules)
+        logger.info(f"Swept {len(sweep)} exotics over {sum(result['explored'] for result in sweep)} combinations")
+
+        ranked = []
+        for result in sweep:
+            loadouts = [self.apply_bonus(loadout, bonus_table, rules) for loadout in result['loadouts']]
+            loadouts = [loadout for loadout in loadouts if loadout is not None]
+            if not loadouts:
+                continue
+            best = max(loadouts, key=lambda loadout: rank_totals(
+                [loadout['final']['total_stats'][stat] for stat in STAT_NAMES], rules
+            ))
+            ranked.append((result, best))
+        ranked.sort(key=lambda entry: rank_totals(
+            [entry[1]['final']['total_stats'][stat] for stat in STAT_NAMES], rules
+        ), reverse=True)
+
+        exotic_ids = [result['exotic_id'] for result, _ in ranked]
+        exotic_hashes = dict(armor_pieces.filter(item_id__in=exotic_ids).values_list('item_id', 'item_hash'))
+        definitions = get_definition_index()
+
+        return {
+            'exotics': [
+                {
+                    'exotic': {
+                        'instanceId': result['exotic_id'],
+                        'item_hash': exotic_hashes.get(result['exotic_id']),
+                        'name': getattr(definitions.get(exotic_hashes.get(result['exotic_id'])), 'name', None),
+                        'type': ARMOR_SLOT_NAMES[result['slot']],
+                    },
+                    **self.format_loadout(best),
+                }
+                for result, best in ranked
+            ],
+            'pruned_pieces': pruned_count,
+        }, missing_ids
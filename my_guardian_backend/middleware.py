@@ -0,0 +1,27 @@
+# my_guardian_backend/middleware.py
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    # WhiteNoise only runs sync, which under ASGI would put every request and
+    # its async view on a thread. Static files are served as before; other
+    # requests are passed on without leaving the event loop.
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        static_file = self.find_file(request.path_info) if self.autorefresh else self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
@@ -34,7 +34,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'my_guardian_backend.middleware.StaticFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -80,6 +80,41 @@ else:
         conn_max_age=600
     )
 }
+
+# Cache shared by every worker: tables in the main database in production.
+# Destiny profile components are megabytes each and only live for seconds, so
+# they get their own table (the 'profiles' cache) where culling can't evict the
+# small keys (locks, API status) kept in 'default'.
+if DEV_MODE:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'profiles': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'profiles',
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'django_cache',
+            'OPTIONS': {
+                'MAX_ENTRIES': 5000,
+                'CULL_FREQUENCY': 4,
+            },
+        },
+        'profiles': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'profile_cache',
+            'OPTIONS': {
+                'MAX_ENTRIES': 2000,
+                'CULL_FREQUENCY': 4,
+            },
+        },
+    }
+
     # Password validation
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -119,6 +154,9 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
     # and renames the files with unique names for each version to support long-term caching
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
+# Downloaded Destiny 2 manifest files, shared by the manifest commands
+MANIFEST_CACHE_DIR = os.environ.get('MANIFEST_CACHE_DIR', os.path.join(BASE_DIR, 'manifest_cache'))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -156,6 +194,12 @@ SOCIAL_AUTH_BUNGIE_KEY = os.environ.get("CLIENT_ID")
 SOCIAL_AUTH_BUNGIE_SECRET = os.environ.get("CLIENT_SECRET")
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
 
+# Worker processes for sharded armor optimization; 0 or 1 keeps the search in-process
+ARMOR_OPTIMIZER_PROCESSES = int(os.environ.get("ARMOR_OPTIMIZER_PROCESSES", 0))
+
+# Route the Bungie proxy and optimize endpoints to their async views; set when serving with uvicorn
+ASYNC_VIEWS = True if os.environ.get("ASYNC_VIEWS") == 'True' else False
+
 # Custom user model
 AUTH_USER_MODEL = "users.NewUser"
 
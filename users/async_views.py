@@ -0,0 +1,186 @@
+# users/async_views.py
+import orjson
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.http import HttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+
+from . import bungie
+from .models import OAuthToken
+from .profiles import aget_profile, ainvalidate_profile, project_profile
+from .tokens import aget_access_token
+from .views import is_destiny_api_enabled, parse_profile_components, sync_user_faves
+
+MAINTENANCE_ERROR = 'Destiny 2 API is currently disabled for maintenance'
+
+
+def json_response(data, status=status.HTTP_200_OK):
+    return HttpResponse(orjson.dumps(data), content_type='application/json', status=status)
+
+
+def read_json(request):
+    # The request body as DRF's request.data would parse it for JSON clients
+    if not request.body:
+        return {}
+    try:
+        data = orjson.loads(request.body)
+    except orjson.JSONDecodeError:
+        raise ValueError('Invalid JSON body')
+    if not isinstance(data, dict):
+        raise ValueError('JSON body must be an object')
+    return data
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAPIView(View):
+    # DRF's APIView only runs sync handlers, so the async views are plain
+    # Django views. Like the DRF views they are open to any caller.
+    pass
+
+
+async def ais_destiny_api_enabled():
+    # is_destiny_api_enabled for async views. Django's async cache methods run
+    # the sync ones in a thread as well, so this costs no more than they would.
+    return await sync_to_async(is_destiny_api_enabled)()
+
+
+async def post_action(username, action, body):
+    # Sends an item action for the user and relays Bungie's answer
+    try:
+        access_token = await aget_access_token(username)
+    except Exception as e:
+        return json_response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    headers = {
+        'X-API-Key': settings.SOCIAL_AUTH_BUNGIE_API_KEY,
+        'Authorization': f'Bearer {access_token}',
+    }
+    response = await bungie.apost(f'https://www.bungie.net/Platform/Destiny2/Actions/Items/{action}/', 'action', headers=headers, json=body)
+
+    if response.status_code == 200:
+        await ainvalidate_profile(username)
+        return json_response(response.json(), status=status.HTTP_200_OK)
+    else:
+        return json_response(response.json(), status=status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncRefreshTokenView(AsyncAPIView):
+    async def post(self, request, *args, **kwargs):
+        try:
+            data = read_json(request)
+        except ValueError as e:
+            return json_response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        username = data.get('username')
+        user_model = get_user_model()
+        try:
+            user = await user_model.objects.aget(username=username)
+        except user_model.DoesNotExist:
+            return json_response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            await aget_access_token(user.username, force_refresh=True)
+        except Exception as e:
+            return json_response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        token = await OAuthToken.objects.aget(user=user)
+        return json_response({
+            'access_token': token.access_token,
+            'refresh_token': token.refresh_token,
+            'expires_in': token.expires_in,
+            'refresh_expires_in': token.refresh_expires_in
+        }, status=status.HTTP_200_OK)
+
+
+class AsyncBungieProfile(AsyncAPIView):
+    async def get(self, request, *args, **kwargs):
+        if not await ais_destiny_api_enabled():
+            return json_response({'error': MAINTENANCE_ERROR}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        username = request.GET.get('username')
+        user_model = get_user_model()
+        try:
+            user = await user_model.objects.aget(username=username)
+        except user_model.DoesNotExist:
+            return json_response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            components = parse_profile_components(request.GET.get('components'))
+        except ValueError as e:
+            return json_response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        fields = [field for field in request.GET.get('fields', '').split(',') if field]
+
+        try:
+            _, response_data = await aget_profile(user, components)
+        except Exception as e:
+            return json_response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if 300 in components:
+            profile_items = response_data.get('Response', {}).get('itemComponents', {}).get('instances', {}).get('data', [])
+            await sync_to_async(sync_user_faves)(user, profile_items)
+
+        return json_response(project_profile(response_data, components, fields), status=status.HTTP_200_OK)
+
+
+class AsyncTransferItem(AsyncAPIView):
+    async def post(self, request, *args, **kwargs):
+        if not await ais_destiny_api_enabled():
+            return json_response({'error': MAINTENANCE_ERROR}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        try:
+            data = read_json(request)
+        except ValueError as e:
+            return json_response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        fields = ['itemReferenceHash', 'stackSize', 'transferToVault', 'itemId', 'characterId', 'membershipType']
+        if None in [data.get('username'), *(data.get(field) for field in fields)]:
+            return json_response({'error': 'All fields are required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        return await post_action(data['username'], 'TransferItem', {field: data[field] for field in fields})
+
+
+class AsyncEquipItem(AsyncAPIView):
+    async def post(self, request, *args, **kwargs):
+        if not await ais_destiny_api_enabled():
+            return json_response({'error': MAINTENANCE_ERROR}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        try:
+            data = read_json(request)
+        except ValueError as e:
+            return json_response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        fields = ['itemId', 'characterId', 'membershipType']
+        if None in [data.get('username'), *(data.get(field) for field in fields)]:
+            return json_response({'error': 'All fields are required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        return await post_action(data['username'], 'EquipItem', {field: data[field] for field in fields})
+
+
+class AsyncEquipItems(AsyncAPIView):
+    async def post(self, request, *args, **kwargs):
+        if not await ais_destiny_api_enabled():
+            return json_response({'error': MAINTENANCE_ERROR}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        try:
+            data = read_json(request)
+        except ValueError as e:
+            return json_response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        username = data.get('username')
+        itemIds = data.get('itemIds', [])
+        characterId = data.get('characterId')
+        membershipType = data.get('membershipType')
+
+        if not username or not itemIds or not characterId or not membershipType:
+            return json_response({'error': 'All fields are required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not isinstance(itemIds, list):
+            return json_response({'error': 'itemIds must be an array'}, status=status.HTTP_400_BAD_REQUEST)
+
+        body = {
+            'itemIds': itemIds,
+            'characterId': characterId,
+            'membershipType': membershipType,
+        }
+        return await post_action(username, 'EquipItems', body)
@@ -0,0 +1,190 @@
+# users/bungie.py
+import asyncio
+import logging
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+BUNGIE_ROOT = 'https://www.bungie.net'
+
+# (connect, read) timeouts in seconds per kind of Bungie endpoint
+TIMEOUTS = {
+    'oauth': (3.05, 10),
+    'settings': (3.05, 5),
+    'user': (3.05, 10),
+    'profile': (3.05, 20),
+    'action': (3.05, 10),
+    'manifest': (3.05, 120),
+}
+
+POOL_SIZE = 20
+# The async views keep many more calls in flight per worker than there are threads
+ASYNC_POOL_SIZE = 500
+MAX_RETRIES = 2
+BACKOFF_SECONDS = 0.5
+# Waits longer than this aren't worth holding a worker for; the caller gets the response as is
+MAX_BACKOFF_SECONDS = 5
+MAX_ENVELOPE_BYTES = 1 << 20
+
+_session = None
+_session_lock = threading.Lock()
+
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> httpx.AsyncClient
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def get_session():
+    # One keep-alive session per worker, shared by every Bungie call
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+            _session = session
+        return _session
+
+
+def get_async_client():
+    # One client per event loop, which under uvicorn is one per worker
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        limits = httpx.Limits(max_connections=ASYNC_POOL_SIZE, max_keepalive_connections=POOL_SIZE)
+        client = _async_clients[loop] = httpx.AsyncClient(limits=limits)
+    return client
+
+
+def _record(endpoint, elapsed_ms, failed=False, retried=False):
+    with _metrics_lock:
+        stats = _metrics.setdefault(endpoint, {'count': 0, 'errors': 0, 'retries': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stats['count'] += 1
+        stats['errors'] += failed
+        stats['retries'] += retried
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+
+
+def get_metrics():
+    # Per-endpoint call counts, failures, retries and latency in ms since the worker started
+    with _metrics_lock:
+        return {
+            endpoint: {**stats, 'avg_ms': stats['total_ms'] / stats['count'] if stats['count'] else 0.0}
+            for endpoint, stats in _metrics.items()
+        }
+
+
+def _throttle_seconds(response):
+    # Bungie asks clients to wait via ThrottleSeconds in the JSON envelope.
+    # Large bodies are manifest downloads, which never carry one.
+    if 'json' not in response.headers.get('Content-Type', '') or len(response.content) > MAX_ENVELOPE_BYTES:
+        return 0
+    try:
+        body = response.json()
+    except ValueError:
+        return 0
+    return body.get('ThrottleSeconds', 0) if isinstance(body, dict) else 0
+
+
+def _retry_delay(response, attempt, idempotent, read_body=True):
+    # Throttled requests were never executed, so they can always be retried;
+    # server errors only for requests that are safe to repeat. Streamed bodies
+    # are left for the caller to read.
+    delay = _throttle_seconds(response) if read_body else 0
+    if idempotent and (response.status_code >= 500 or response.status_code == 429):
+        delay = max(delay, BACKOFF_SECONDS * 2 ** attempt)
+    if not delay or delay > MAX_BACKOFF_SECONDS:
+        return None
+    return delay
+
+
+def request(method, url, endpoint, **kwargs):
+    # Sends one Bungie request through the pooled session with the endpoint's
+    # timeouts, retrying with backoff on throttling, 5xx and connection errors
+    if not url.startswith('http'):
+        url = f'{BUNGIE_ROOT}{url}'
+    kwargs.setdefault('timeout', TIMEOUTS[endpoint])
+    idempotent = method.upper() == 'GET'
+    streamed = kwargs.get('stream', False)
+    session = get_session()
+
+    for attempt in range(MAX_RETRIES + 1):
+        started = time.monotonic()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            elapsed_ms = (time.monotonic() - started) * 1000
+            retry = idempotent and attempt < MAX_RETRIES
+            _record(endpoint, elapsed_ms, failed=True, retried=retry)
+            logger.warning(f"Bungie {endpoint} request failed after {elapsed_ms:.0f} ms: {e}")
+            if not retry:
+                raise
+            time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+            continue
+
+        elapsed_ms = (time.monotonic() - started) * 1000
+        delay = _retry_delay(response, attempt, idempotent, read_body=not streamed) if attempt < MAX_RETRIES else None
+        _record(endpoint, elapsed_ms, failed=response.status_code >= 400, retried=delay is not None)
+        logger.debug(f"Bungie {endpoint} {method} {response.status_code} in {elapsed_ms:.0f} ms")
+        if delay is None:
+            return response
+        logger.warning(f"Bungie {endpoint} returned {response.status_code}, retrying in {delay} s")
+        response.close()
+        time.sleep(delay)
+
+
+def get(url, endpoint, **kwargs):
+    return request('GET', url, endpoint, **kwargs)
+
+
+def post(url, endpoint, **kwargs):
+    return request('POST', url, endpoint, **kwargs)
+
+
+async def arequest(method, url, endpoint, **kwargs):
+    # request() for async views: same timeouts, retries and metrics, but the
+    # worker's event loop keeps serving other requests while this one waits
+    if not url.startswith('http'):
+        url = f'{BUNGIE_ROOT}{url}'
+    connect, read = TIMEOUTS[endpoint]
+    kwargs.setdefault('timeout', httpx.Timeout(read, connect=connect))
+    idempotent = method.upper() == 'GET'
+    client = get_async_client()
+
+    for attempt in range(MAX_RETRIES + 1):
+        started = time.monotonic()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            elapsed_ms = (time.monotonic() - started) * 1000
+            retry = idempotent and attempt < MAX_RETRIES
+            _record(endpoint, elapsed_ms, failed=True, retried=retry)
+            logger.warning(f"Bungie {endpoint} request failed after {elapsed_ms:.0f} ms: {e}")
+            if not retry:
+                raise
+            await asyncio.sleep(BACKOFF_SECONDS * 2 ** attempt)
+            continue
+
+        elapsed_ms = (time.monotonic() - started) * 1000
+        delay = _retry_delay(response, attempt, idempotent) if attempt < MAX_RETRIES else None
+        _record(endpoint, elapsed_ms, failed=response.status_code >= 400, retried=delay is not None)
+        logger.debug(f"Bungie {endpoint} {method} {response.status_code} in {elapsed_ms:.0f} ms")
+        if delay is None:
+            return response
+        logger.warning(f"Bungie {endpoint} returned {response.status_code}, retrying in {delay} s")
+        await asyncio.sleep(delay)
+
+
+async def aget(url, endpoint, **kwargs):
+    return await arequest('GET', url, endpoint, **kwargs)
+
+
+async def apost(url, endpoint, **kwargs):
+    return await arequest('POST', url, endpoint, **kwargs)
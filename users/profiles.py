@@ -0,0 +1,343 @@
+# users/profiles.py
+import asyncio
+import logging
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.core.cache import cache, caches
+
+from . import bungie
+from .tokens import aget_access_token, get_access_token
+
+logger = logging.getLogger(__name__)
+
+# How long a fetched profile component is served to other callers. Components
+# go to the 'profiles' cache, which every worker shares.
+PROFILE_CACHE_SECONDS = 15
+# How long an item action keeps the components fetched before it out of use:
+# longer than a profile fetch with its retries can take plus PROFILE_CACHE_SECONDS
+PROFILE_CHANGED_SECONDS = 120
+# How long a worker waits for another worker's fetch of the same profile
+PROFILE_WAIT_SECONDS = 20
+PROFILE_POLL_SECONDS = 0.05
+
+# Where each cacheable component lives in the Profile response. Components
+# not listed here are always fetched from Bungie.
+COMPONENT_PATHS = {
+    100: (('profile',),),
+    102: (('profileInventory',),),
+    200: (('characters',),),
+    201: (('characterInventories',),),
+    205: (('characterEquipment',),),
+    300: (('itemComponents', 'instances'),),
+    302: (('itemComponents', 'perks'),),
+    304: (('itemComponents', 'stats'),),
+    305: (('itemComponents', 'sockets'),),
+    308: (('itemComponents', 'plugObjectives'),),
+}
+
+
+class _Flight:
+    __slots__ = ('started', 'done', 'result', 'error')
+
+    def __init__(self, started):
+        self.started = started
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}  # membership -> {frozenset of components: _Flight}
+_flights_lock = threading.Lock()
+_async_flights = weakref.WeakKeyDictionary()  # event loop -> {membership: {frozenset of components: (started, Future)}}
+
+
+def _single_flight(membership, components, changed_at, fetch):
+    # Callers asking for a profile while a fetch of the same or a larger
+    # component set is running wait for it and share its result, unless the
+    # fetch started before the profile last changed
+    components = frozenset(components)
+    with _flights_lock:
+        flights = _flights.setdefault(membership, {})
+        flight = next((
+            flight for fetched, flight in flights.items() if fetched >= components and flight.started > changed_at
+        ), None)
+        leader = flight is None
+        if leader:
+            flight = flights[components] = _Flight(time.time())
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = fetch()
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            # A later fetch may have taken the place of this stale one
+            if flights.get(components) is flight:
+                del flights[components]
+            if not flights and _flights.get(membership) is flights:
+                del _flights[membership]
+        flight.done.set()
+    return flight.result
+
+
+def component_cache_key(user, component):
+    return f"bungie:profile:{user.membership_type}:{user.primary_membership_id}:component:{component}"
+
+
+def _component_keys(user, components):
+    return {component_cache_key(user, component): component for component in components if component in COMPONENT_PATHS}
+
+
+def _changed_key(username):
+    return f"bungie:profile:{username}:changed"
+
+
+def invalidate_profile(username):
+    # Called after an item action changed the user's inventory. The time is
+    # kept in the shared cache so every worker stops serving components (and
+    # sharing fetches) from before it.
+    cache.set(_changed_key(username), time.time(), PROFILE_CHANGED_SECONDS)
+
+
+async def ainvalidate_profile(username):
+    await cache.aset(_changed_key(username), time.time(), PROFILE_CHANGED_SECONDS)
+
+
+def _get_cached_components(user, components, changed_at):
+    # {component: {path: value}} for the requested components that are fresh
+    keys = _component_keys(user, components)
+    return {
+        keys[key]: entry for key, (fetched_at, entry) in caches['profiles'].get_many(keys).items() if fetched_at > changed_at
+    }
+
+
+async def _aget_cached_components(user, components, changed_at):
+    keys = _component_keys(user, components)
+    return {
+        keys[key]: entry for key, (fetched_at, entry) in (await caches['profiles'].aget_many(keys)).items()
+        if fetched_at > changed_at
+    }
+
+
+def _component_entries(user, components, data, fetched_at):
+    # Each component is stored on its own, with the time its fetch started, so
+    # later requests for any mix of components can reuse it; paths Bungie left
+    # out (e.g. private data) are stored as absent
+    entries = {}
+    for component in components:
+        if component not in COMPONENT_PATHS:
+            continue
+        entry = {}
+        for path in COMPONENT_PATHS[component]:
+            value = data
+            for field in path:
+                value = value.get(field) if isinstance(value, dict) else None
+            if value is not None:
+                entry[path] = value
+        entries[component_cache_key(user, component)] = (fetched_at, entry)
+    return entries
+
+
+def _assemble(cached, response_data=None):
+    # Bungie-shaped response made of the fetched response (if any) plus the cached components
+    if response_data is None:
+        response_data = {'Response': {}, 'ErrorCode': 1, 'ThrottleSeconds': 0, 'ErrorStatus': 'Success', 'Message': 'Ok', 'MessageData': {}}
+    data = dict(response_data['Response'])
+    for entry in cached.values():
+        for path, value in entry.items():
+            target = data
+            for field in path[:-1]:
+                target[field] = target = dict(target.get(field, {}))
+            target[path[-1]] = value
+    return {**response_data, 'Response': data}
+
+
+def _lock_key(user, components, changed_at):
+    # Fetches started before the profile last changed don't hold up newer ones
+    return f"bungie:profile:{user.membership_type}:{user.primary_membership_id}:{','.join(map(str, components))}:{changed_at}:fetching"
+
+
+def _profile_request(user, components, access_token):
+    headers = {
+        'X-API-Key': settings.SOCIAL_AUTH_BUNGIE_API_KEY,
+        'Authorization': f'Bearer {access_token}',
+    }
+    url = f"https://www.bungie.net/Platform/Destiny2/{user.membership_type}/Profile/{user.primary_membership_id}/?components={','.join(map(str, components))}"
+    return url, headers
+
+
+def _is_complete(status_code, response_data):
+    # Only complete profiles are shared; errors go back to this caller and its waiters
+    return status_code == 200 and response_data.get('ErrorCode', 1) == 1
+
+
+def _fetch_profile(user, components, changed_at):
+    cached = _get_cached_components(user, components, changed_at)
+    missing = [component for component in components if component not in cached]
+    if not missing:
+        return 200, _assemble(cached)
+
+    # A worker already fetching these components publishes them in the shared cache
+    lock_key = _lock_key(user, missing, changed_at)
+    owns_lock = cache.add(lock_key, True, PROFILE_WAIT_SECONDS)
+    deadline = time.monotonic() + PROFILE_WAIT_SECONDS
+    while not owns_lock and time.monotonic() < deadline:
+        time.sleep(PROFILE_POLL_SECONDS)
+        cached.update(_get_cached_components(user, missing, changed_at))
+        if all(component in cached for component in missing):
+            return 200, _assemble(cached)
+        owns_lock = cache.add(lock_key, True, PROFILE_WAIT_SECONDS)
+    missing = [component for component in components if component not in cached]
+
+    try:
+        fetched_at = time.time()
+        url, headers = _profile_request(user, missing, get_access_token(user.username))
+        response = bungie.get(url, 'profile', headers=headers)
+        response_data = response.json()
+        if not _is_complete(response.status_code, response_data):
+            return response.status_code, response_data
+        entries = _component_entries(user, missing, response_data.get('Response', {}), fetched_at)
+        caches['profiles'].set_many(entries, PROFILE_CACHE_SECONDS)
+        logger.debug(f"Profile components {missing} fetched, {sorted(cached)} served from cache")
+        return response.status_code, _assemble(cached, response_data)
+    finally:
+        if owns_lock:
+            cache.delete(lock_key)
+
+
+def get_profile(user, components):
+    # Returns (status code, parsed Bungie response) for the user's Destiny2
+    # Profile with at least the given components. Components are cached one by
+    # one for PROFILE_CACHE_SECONDS, so only the ones missing from the cache
+    # are fetched. Concurrent callers in this worker share one fetch, and
+    # callers in other workers asking for the same missing components wait for
+    # it through the shared cache. Nothing fetched before the last
+    # invalidate_profile() is reused.
+    components = sorted({int(component) for component in components})
+    changed_at = cache.get(_changed_key(user.username), 0)
+    cached = _get_cached_components(user, components, changed_at)
+    if len(cached) == len(components):
+        return 200, _assemble(cached)
+    membership = (user.membership_type, user.primary_membership_id)
+    return _single_flight(membership, components, changed_at, lambda: _fetch_profile(user, components, changed_at))
+
+
+
+async def _asingle_flight(membership, components, changed_at, fetch):
+    # _single_flight for async views; flights belong to the running event loop
+    loop = asyncio.get_running_loop()
+    components = frozenset(components)
+    flights = _async_flights.setdefault(loop, {}).setdefault(membership, {})
+    future = next((
+        future for fetched, (started, future) in flights.items() if fetched >= components and started > changed_at
+    ), None)
+    if future is not None:
+        # A waiter giving up must not cancel the fetch the others wait for
+        return await asyncio.shield(future)
+
+    future = loop.create_future()
+    flights[components] = (time.time(), future)
+    try:
+        result = await fetch()
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(e)
+            future.exception()  # the waiters re-raise it; don't warn when there are none
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        # A later fetch may have taken the place of this stale one
+        if flights.get(components, (None, None))[1] is future:
+            del flights[components]
+        if not flights and _async_flights[loop].get(membership) is flights:
+            del _async_flights[loop][membership]
+
+
+async def _afetch_profile(user, components, changed_at):
+    cached = await _aget_cached_components(user, components, changed_at)
+    missing = [component for component in components if component not in cached]
+    if not missing:
+        return 200, _assemble(cached)
+
+    lock_key = _lock_key(user, missing, changed_at)
+    owns_lock = await cache.aadd(lock_key, True, PROFILE_WAIT_SECONDS)
+    deadline = time.monotonic() + PROFILE_WAIT_SECONDS
+    while not owns_lock and time.monotonic() < deadline:
+        await asyncio.sleep(PROFILE_POLL_SECONDS)
+        cached.update(await _aget_cached_components(user, missing, changed_at))
+        if all(component in cached for component in missing):
+            return 200, _assemble(cached)
+        owns_lock = await cache.aadd(lock_key, True, PROFILE_WAIT_SECONDS)
+    missing = [component for component in components if component not in cached]
+
+    try:
+        fetched_at = time.time()
+        url, headers = _profile_request(user, missing, await aget_access_token(user.username))
+        response = await bungie.aget(url, 'profile', headers=headers)
+        response_data = response.json()
+        if not _is_complete(response.status_code, response_data):
+            return response.status_code, response_data
+        entries = _component_entries(user, missing, response_data.get('Response', {}), fetched_at)
+        await caches['profiles'].aset_many(entries, PROFILE_CACHE_SECONDS)
+        return response.status_code, _assemble(cached, response_data)
+    finally:
+        if owns_lock:
+            await cache.adelete(lock_key)
+
+
+async def aget_profile(user, components):
+    # get_profile for async views, sharing its component cache
+    components = sorted({int(component) for component in components})
+    changed_at = await cache.aget(_changed_key(user.username), 0)
+    cached = await _aget_cached_components(user, components, changed_at)
+    if len(cached) == len(components):
+        return 200, _assemble(cached)
+    membership = (user.membership_type, user.primary_membership_id)
+    return await _asingle_flight(membership, components, changed_at, lambda: _afetch_profile(user, components, changed_at))
+
+
+def _project_items(items, fields):
+    return [{field: item[field] for field in fields if field in item} for item in items]
+
+
+def project_profile(response_data, components, fields=()):
+    # Copy of a Profile response with only the sections of the given components
+    # and, when fields are given, inventory and equipment items that only keep
+    # those fields. Responses shared with other callers may carry more sections.
+    paths = {path for component, component_paths in COMPONENT_PATHS.items() if component not in components for path in component_paths}
+    data = {key: value for key, value in response_data.get('Response', {}).items() if (key,) not in paths}
+    if 'itemComponents' in data:
+        data['itemComponents'] = {
+            key: value for key, value in data['itemComponents'].items() if ('itemComponents', key) not in paths
+        }
+    if not fields:
+        return {**response_data, 'Response': data}
+
+    if 'profileInventory' in data:
+        section = data['profileInventory']
+        items = section.get('data', {}).get('items', [])
+        data['profileInventory'] = {**section, 'data': {**section.get('data', {}), 'items': _project_items(items, fields)}}
+    for name in ('characterInventories', 'characterEquipment'):
+        if name not in data:
+            continue
+        section = data[name]
+        characters = {
+            character_id: {**inventory, 'items': _project_items(inventory.get('items', []), fields)}
+            for character_id, inventory in section.get('data', {}).items()
+        }
+        data[name] = {**section, 'data': characters}
+    return {**response_data, 'Response': data}
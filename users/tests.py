@@ -1,3 +1,338 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import requests
+from django.core.cache import cache, caches
+from django.db import connection
+from django.test import SimpleTestCase, TransactionTestCase
+from django.utils import timezone
+
+from . import bungie, profiles, tokens, views
+from .models import NewUser, OAuthToken
+
+
+def bungie_response(status_code=200, body=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers['Content-Type'] = 'application/json; charset=utf-8'
+    response._content = json.dumps(body if body is not None else {'ErrorCode': 1}).encode()
+    return response
+
+
+class FakeProfileResponse:
+    status_code = 200
+
+    def __init__(self, components):
+        data = {}
+        for component in components:
+            target = data
+            *parents, name = profiles.COMPONENT_PATHS[component][0]
+            for field in parents:
+                target = target.setdefault(field, {})
+            target[name] = {'data': component}
+        self.data = {'ErrorCode': 1, 'Response': data}
+
+    def json(self):
+        return self.data
+
+
+class BungieClientTests(SimpleTestCase):
+    def setUp(self):
+        self.session = mock.Mock()
+        self.sleeps = []
+        for patcher in [
+            mock.patch.object(bungie, 'get_session', return_value=self.session),
+            mock.patch.object(bungie.time, 'sleep', self.sleeps.append),
+            mock.patch.dict(bungie._metrics, clear=True),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def send(self, method, *responses, endpoint='profile'):
+        self.session.request.side_effect = responses
+        return bungie.request(method, '/Platform/Destiny2/', endpoint)
+
+    def test_server_errors_are_retried_with_backoff(self):
+        response = self.send('GET', bungie_response(503), bungie_response(502), bungie_response())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.sleeps, [0.5, 1.0])
+        self.session.request.assert_called_with(
+            'GET', 'https://www.bungie.net/Platform/Destiny2/', timeout=bungie.TIMEOUTS['profile'],
+        )
+        metrics = bungie.get_metrics()['profile']
+        self.assertEqual((metrics['count'], metrics['errors'], metrics['retries']), (3, 2, 2))
+
+    def test_gives_up_after_the_last_attempt(self):
+        response = self.send('GET', *[bungie_response(500)] * (bungie.MAX_RETRIES + 1))
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.session.request.call_count, bungie.MAX_RETRIES + 1)
+        self.assertEqual(len(self.sleeps), bungie.MAX_RETRIES)
+        metrics = bungie.get_metrics()['profile']
+        self.assertEqual((metrics['errors'], metrics['retries']), (bungie.MAX_RETRIES + 1, bungie.MAX_RETRIES))
+
+    def test_throttled_requests_wait_as_asked(self):
+        # Throttled calls were never executed, so even a POST is sent again
+        throttled = bungie_response(200, {'ErrorCode': 51, 'ThrottleSeconds': 2})
+        response = self.send('POST', throttled, bungie_response(), endpoint='action')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.sleeps, [2])
+
+    def test_no_retry_when_unsafe_or_too_slow(self):
+        self.assertEqual(self.send('POST', bungie_response(500), endpoint='action').status_code, 500)
+        throttled = bungie_response(200, {'ThrottleSeconds': bungie.MAX_BACKOFF_SECONDS + 1})
+        self.assertIs(self.send('GET', throttled), throttled)
+        self.assertEqual(self.sleeps, [])
+
+    def test_timeouts_are_retried_then_raised(self):
+        self.session.request.side_effect = requests.Timeout('read timed out')
+        with self.assertRaises(requests.Timeout):
+            bungie.get('/Platform/Destiny2/', 'profile')
+        self.assertEqual(self.session.request.call_count, bungie.MAX_RETRIES + 1)
+        self.assertEqual(self.sleeps, [0.5, 1.0])
+        metrics = bungie.get_metrics()['profile']
+        self.assertEqual((metrics['count'], metrics['errors'], metrics['retries']), (3, 3, 2))
+
+        # A POST may already have run, so it fails at once
+        self.session.request.reset_mock()
+        self.session.request.side_effect = requests.ConnectionError('reset')
+        with self.assertRaises(requests.ConnectionError):
+            bungie.post('/Platform/Destiny2/Actions/', 'action')
+        self.assertEqual(self.session.request.call_count, 1)
+
+    def test_async_requests_retry_the_same_way(self):
+        statuses = iter([503, 200])
+
+        def handler(request):
+            self.assertEqual(request.extensions['timeout']['read'], bungie.TIMEOUTS['user'][1])
+            return httpx.Response(next(statuses), json={'ErrorCode': 1})
+
+        async def send():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                with mock.patch.object(bungie, 'get_async_client', return_value=client), \
+                        mock.patch.object(bungie.asyncio, 'sleep', mock.AsyncMock()) as sleep:
+                    response = await bungie.aget('/Platform/User/', 'user')
+            return response, sleep
+
+        response, sleep = asyncio.run(send())
+        self.assertEqual(response.status_code, 200)
+        sleep.assert_awaited_once_with(0.5)
+        self.assertEqual(bungie.get_metrics()['user']['retries'], 1)
+
+
+class DestinyApiStatusTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        # Refreshes are queued instead of started so each test decides when they run
+        self.refreshes = []
+        patcher = mock.patch.object(views.threading, 'Thread', self.queue_refresh)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def queue_refresh(self, target, daemon):
+        self.refreshes.append(target)
+        return mock.Mock()
+
+    def settings_response(self, enabled):
+        return bungie_response(200, {'Response': {'Destiny2': {'enabled': enabled}}})
+
+    def set_status(self, enabled, age):
+        cache.set(views.API_STATUS_CACHE_KEY, {'enabled': enabled, 'checked_at': time.time() - age})
+
+    def test_fresh_status_is_served_from_the_cache(self):
+        self.set_status(False, 0)
+        with mock.patch.object(views.bungie, 'get') as get:
+            self.assertFalse(views.is_destiny_api_enabled())
+        get.assert_not_called()
+        self.assertEqual(self.refreshes, [])
+
+    def test_stale_status_triggers_one_refresh(self):
+        self.set_status(True, views.API_STATUS_TTL_SECONDS + 1)
+        # The stale value is served while a single refresh is pending
+        self.assertTrue(views.is_destiny_api_enabled())
+        self.assertTrue(views.is_destiny_api_enabled())
+        self.assertEqual(len(self.refreshes), 1)
+
+        with mock.patch.object(views.bungie, 'get', return_value=self.settings_response(False)) as get:
+            self.refreshes[0]()
+        get.assert_called_once_with('https://www.bungie.net/Platform/Settings/', 'settings')
+        self.assertFalse(views.is_destiny_api_enabled())
+        self.assertEqual(len(self.refreshes), 1)
+
+    def test_upstream_failure_assumes_the_api_is_up(self):
+        self.set_status(False, views.API_STATUS_TTL_SECONDS + 1)
+        for failure in [mock.Mock(side_effect=requests.ConnectionError('down')), mock.Mock(return_value=bungie_response(503))]:
+            self.assertFalse(views.is_destiny_api_enabled())
+            with mock.patch.object(views.bungie, 'get', failure):
+                self.refreshes[-1]()
+            # The refresh lock is released even so, and the failure is cached as up
+            self.assertIsNone(cache.get(views.API_STATUS_REFRESH_KEY))
+            self.assertTrue(views.is_destiny_api_enabled())
+            self.set_status(False, views.API_STATUS_TTL_SECONDS + 1)
+        self.assertEqual(len(self.refreshes), 2)
+
+
+class AccessTokenTests(TransactionTestCase):
+    # Not a TestCase, so the refresh can be checked to run outside a transaction
+    def setUp(self):
+        user = NewUser.objects.create(username='guardian', primary_membership_id='1', membership_type='3')
+        self.token = OAuthToken.objects.create(
+            user=user, access_token='old', refresh_token='refresh', expires_in=3600, refresh_expires_in=7776000,
+        )
+        cache.clear()
+        self.addCleanup(cache.clear)
+        patcher = mock.patch.dict(tokens._hot_tokens, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def expire_in(self, seconds):
+        created_at = timezone.now() - timedelta(seconds=self.token.expires_in - seconds)
+        OAuthToken.objects.filter(pk=self.token.pk).update(created_at=created_at)
+
+    def refreshed(self, access_token='new'):
+        def post(url, endpoint, headers, data):
+            self.assertFalse(connection.in_atomic_block)
+            self.assertEqual(data['refresh_token'], 'refresh')
+            return bungie_response(200, {'access_token': access_token, 'expires_in': 3600, 'refresh_expires_in': 7776000})
+        return mock.patch.object(tokens.bungie, 'post', side_effect=post)
+
+    def test_valid_tokens_are_reused(self):
+        with mock.patch.object(tokens.bungie, 'post') as post:
+            self.assertEqual(tokens.get_access_token('guardian'), 'old')
+            # The second call is served from the worker's cache
+            with self.assertNumQueries(0):
+                self.assertEqual(tokens.get_access_token('guardian'), 'old')
+        post.assert_not_called()
+        self.assertEqual(tokens._user_locks, {})
+
+    def test_refreshes_near_expiry(self):
+        self.expire_in(tokens.EXPIRY_MARGIN_SECONDS - 10)
+        with self.refreshed() as post:
+            self.assertEqual(tokens.get_access_token('guardian'), 'new')
+            self.assertEqual(tokens.get_access_token('guardian'), 'new')
+        post.assert_called_once()
+        self.assertEqual(OAuthToken.objects.get().access_token, 'new')
+        self.assertIsNone(cache.get(tokens._refresh_key('guardian')))
+        self.assertEqual(tokens._user_locks, {})
+
+        # Outside the margin the stored token is kept
+        tokens.forget_access_token('guardian')
+        self.expire_in(tokens.EXPIRY_MARGIN_SECONDS + 60)
+        with mock.patch.object(tokens.bungie, 'post') as post:
+            self.assertEqual(tokens.get_access_token('guardian'), 'new')
+        post.assert_not_called()
+
+    def test_a_concurrent_refresh_wins(self):
+        # Another worker stores its token while this one waits on Bungie
+        def other_worker_refreshes(*args, **kwargs):
+            OAuthToken.objects.filter(pk=self.token.pk).update(access_token='theirs', created_at=timezone.now())
+            return bungie_response(200, {'access_token': 'ours', 'expires_in': 3600, 'refresh_expires_in': 7776000})
+
+        self.expire_in(0)
+        with mock.patch.object(tokens.bungie, 'post', side_effect=other_worker_refreshes):
+            self.assertEqual(tokens.get_access_token('guardian'), 'theirs')
+        self.assertEqual(OAuthToken.objects.get().access_token, 'theirs')
+
+    def test_waits_for_a_refresh_in_another_worker(self):
+        self.expire_in(0)
+        cache.add(tokens._refresh_key('guardian'), True)
+
+        def other_worker_finishes(seconds):
+            OAuthToken.objects.filter(pk=self.token.pk).update(access_token='theirs', created_at=timezone.now())
+
+        with mock.patch.object(tokens.time, 'sleep', other_worker_finishes), \
+                mock.patch.object(tokens.bungie, 'post') as post:
+            self.assertEqual(tokens.get_access_token('guardian'), 'theirs')
+        post.assert_not_called()
+
+
+class ProfileCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.user = NewUser(username='guardian', primary_membership_id='1', membership_type='3')
+        self.fetched = []
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.addCleanup(caches['profiles'].clear)
+        for patcher in [
+            mock.patch.object(profiles.bungie, 'get', self.fake_get),
+            mock.patch.object(profiles, 'get_access_token', return_value='token'),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fake_get(self, url, endpoint, **kwargs):
+        components = [int(component) for component in url.split('components=')[1].split(',')]
+        self.fetched.append(components)
+        time.sleep(0.05)
+        return FakeProfileResponse(components)
+
+    def test_only_missing_components_are_fetched(self):
+        profiles.get_profile(self.user, [102, 201])
+        status_code, data = profiles.get_profile(self.user, [100, 102, 201])
+        self.assertEqual(status_code, 200)
+        self.assertEqual(self.fetched, [[102, 201], [100]])
+        self.assertEqual(sorted(data['Response']), ['characterInventories', 'profile', 'profileInventory'])
+
+    def test_components_from_another_worker_are_reused(self):
+        # Another worker's fetch only reaches this one through the shared cache
+        entries = profiles._component_entries(self.user, [102], FakeProfileResponse([102]).data['Response'], time.time())
+        caches['profiles'].set_many(entries)
+        status_code, data = profiles.get_profile(self.user, [102])
+        self.assertEqual((status_code, data['Response']), (200, {'profileInventory': {'data': 102}}))
+        self.assertEqual(self.fetched, [])
+
+    def test_concurrent_callers_share_one_fetch(self):
+        threads = [threading.Thread(target=profiles.get_profile, args=(self.user, [102, 201])) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.fetched, [[102, 201]])
+
+    def test_waits_for_a_fetch_in_another_worker(self):
+        lock_key = profiles._lock_key(self.user, [102], 0)
+        cache.add(lock_key, True)
+
+        def other_worker_finishes():
+            time.sleep(0.1)
+            data = FakeProfileResponse([102]).data['Response']
+            caches['profiles'].set_many(profiles._component_entries(self.user, [102], data, time.time()))
+            cache.delete(lock_key)
+
+        other_worker = threading.Thread(target=other_worker_finishes)
+        other_worker.start()
+        status_code, data = profiles.get_profile(self.user, [102])
+        other_worker.join()
+        self.assertEqual((status_code, data['Response']), (200, {'profileInventory': {'data': 102}}))
+        self.assertEqual(self.fetched, [])
+
+        # When the other worker gives up without storing anything, the waiter fetches
+        lock_key = profiles._lock_key(self.user, [201], 0)
+        cache.add(lock_key, True)
+        threading.Timer(0.1, cache.delete, [lock_key]).start()
+        profiles.get_profile(self.user, [201])
+        self.assertEqual(self.fetched, [[201]])
+        self.assertIsNone(cache.get(lock_key))
+
+    def test_invalidate_profile(self):
+        profiles.get_profile(self.user, [102, 201])
+        profiles.invalidate_profile(self.user.username)
+        profiles.get_profile(self.user, [102, 201])
+        profiles.get_profile(self.user, [102, 201])
+        self.assertEqual(self.fetched, [[102, 201], [102, 201]])
+
+    def test_fetch_running_during_an_action_is_not_shared(self):
+        first = threading.Thread(target=profiles.get_profile, args=(self.user, [102]))
+        first.start()
+        time.sleep(0.01)
+        profiles.invalidate_profile(self.user.username)
+        time.sleep(0.01)
+        profiles.get_profile(self.user, [102])
+        first.join()
+        profiles.get_profile(self.user, [102])
+        self.assertEqual(self.fetched, [[102], [102]])
@@ -0,0 +1,149 @@
+# users/tokens.py
+import base64
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import bungie
+from .models import OAuthToken
+
+TOKEN_URL = "https://www.bungie.net/platform/app/oauth/token/"
+
+# Tokens are refreshed this long before Bungie expires them, so one handed
+# out now still works for the Bungie calls of the same request
+EXPIRY_MARGIN_SECONDS = 300
+# How long a worker waits for another worker's refresh of the same token
+REFRESH_WAIT_SECONDS = 15
+REFRESH_POLL_SECONDS = 0.1
+
+_hot_tokens = {}  # username -> (access_token, expires_at as a unix timestamp)
+_user_locks = {}  # username -> [lock, number of threads holding or waiting for it]
+_user_locks_lock = threading.Lock()
+
+
+@contextmanager
+def _user_lock(username):
+    # Entries only live while a thread uses them, so the map stays as small as
+    # the number of users being refreshed right now
+    with _user_locks_lock:
+        entry = _user_locks.setdefault(username, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _user_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _user_locks[username]
+
+
+def _refresh_key(username):
+    return f"bungie:token:{username}:refreshing"
+
+
+def _load_token(username):
+    token = OAuthToken.objects.filter(user__username=username).first()
+    if token is None:
+        raise OAuthToken.DoesNotExist(f'No OAuth token for {username}')
+    return token
+
+
+def _expires_at(token):
+    return (token.created_at + timedelta(seconds=token.expires_in)).timestamp()
+
+
+def _is_fresh(expires_at):
+    return expires_at - EXPIRY_MARGIN_SECONDS > time.time()
+
+
+def _request_refresh(token):
+    # Runs outside any transaction. The row is only updated if nobody else
+    # replaced the token meanwhile; otherwise the stored token wins.
+    client_id_secret = f"{settings.SOCIAL_AUTH_BUNGIE_KEY}:{settings.SOCIAL_AUTH_BUNGIE_SECRET}"
+    client_id_secret_base64 = base64.b64encode(client_id_secret.encode()).decode()
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'Authorization': f'Basic {client_id_secret_base64}'
+    }
+    payload = {
+        'grant_type': 'refresh_token',
+        'refresh_token': token.refresh_token,
+    }
+    response = bungie.post(TOKEN_URL, 'oauth', headers=headers, data=payload)
+    if response.status_code != 200:
+        raise Exception('Failed to refresh Bungie token')
+
+    response_data = response.json()
+    OAuthToken.objects.filter(pk=token.pk, created_at=token.created_at).update(
+        access_token=response_data.get('access_token'), expires_in=response_data.get('expires_in'),
+        refresh_expires_in=response_data.get('refresh_expires_in'), created_at=timezone.now())
+    return OAuthToken.objects.get(pk=token.pk)
+
+
+def _refresh_once(username, token):
+    # Refreshes token unless another worker replaces it first
+    lock_key = _refresh_key(username)
+    owns_lock = cache.add(lock_key, True, REFRESH_WAIT_SECONDS)
+    deadline = time.monotonic() + REFRESH_WAIT_SECONDS
+    while not owns_lock and time.monotonic() < deadline:
+        time.sleep(REFRESH_POLL_SECONDS)
+        latest = _load_token(username)
+        if latest.created_at != token.created_at:
+            return latest
+        owns_lock = cache.add(lock_key, True, REFRESH_WAIT_SECONDS)
+
+    try:
+        # The token may have been replaced between the first read and the lock
+        latest = _load_token(username)
+        if latest.created_at != token.created_at:
+            return latest
+        return _request_refresh(token)
+    finally:
+        if owns_lock:
+            cache.delete(lock_key)
+
+
+def get_access_token(username, force_refresh=False):
+    # Returns a Bungie access token for the user, refreshing it only when it is
+    # close to expiry (or when forced). Valid tokens are served from a per-worker
+    # cache. Concurrent refreshes for one user collapse into a single call: a
+    # thread lock within the worker and a lock in the shared cache across
+    # workers, whose waiters pick the new token up from the database.
+    if not force_refresh:
+        cached = _hot_tokens.get(username)
+        if cached and _is_fresh(cached[1]):
+            return cached[0]
+
+    with _user_lock(username):
+        cached = _hot_tokens.get(username)
+        if not force_refresh and cached and _is_fresh(cached[1]):
+            return cached[0]
+
+        token = _load_token(username)
+        if force_refresh or not _is_fresh(_expires_at(token)):
+            token = _refresh_once(username, token)
+
+        _hot_tokens[username] = (token.access_token, _expires_at(token))
+        return token.access_token
+
+
+def forget_access_token(username):
+    # Drops the worker's cached token after the stored one was replaced
+    _hot_tokens.pop(username, None)
+
+
+async def aget_access_token(username, force_refresh=False):
+    # get_access_token for async views. Valid tokens come straight from the
+    # worker's cache; refreshes go through the sync ORM.
+    if not force_refresh:
+        cached = _hot_tokens.get(username)
+        if cached and _is_fresh(cached[1]):
+            return cached[0]
+    return await sync_to_async(get_access_token)(username, force_refresh)
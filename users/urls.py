@@ -1,6 +1,13 @@
+from django.conf import settings
 from django.urls import path
 from .views import CustomUserCreate, BungieAuth, BungieProfile, GetFaveItems, SetFaveItem, DeleteFaveItem, TransferItem, RefreshTokenView, EquipItem, EquipItems
 
+if settings.ASYNC_VIEWS:
+    from .async_views import (
+        AsyncBungieProfile as BungieProfile, AsyncTransferItem as TransferItem, AsyncRefreshTokenView as RefreshTokenView,
+        AsyncEquipItem as EquipItem, AsyncEquipItems as EquipItems,
+    )
+
 app_name = 'users'
 
 urlpatterns = [
@@ -1,19 +1,48 @@
-import base64
-from django.db import IntegrityError
+import time
+import threading
+from django.db import IntegrityError, connection
+import orjson
 import requests
 from typing import Dict, Any
+from . import bungie
+from .tokens import forget_access_token, get_access_token
+from .profiles import get_profile, invalidate_profile, project_profile
 from .models import UserFaves, OAuthToken
 from datetime import timedelta
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ObjectDoesNotExist
+from django.http import HttpResponse
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
 from .serializers import CustomUserSerializer, UserFavesSerializer
 
+API_STATUS_CACHE_KEY = 'bungie:destiny_api_status'
+API_STATUS_REFRESH_KEY = 'bungie:destiny_api_status:refreshing'
+API_STATUS_TTL_SECONDS = 60
+API_STATUS_STALE_SECONDS = 15 * 60
+API_STATUS_REFRESH_TIMEOUT = 30
+
+PROFILE_COMPONENTS = [100, 102, 200, 201, 205, 300, 302, 304, 305, 308]
+
+
+def parse_profile_components(value):
+    # Comma-separated subset of PROFILE_COMPONENTS, all of them when not given
+    if not value:
+        return PROFILE_COMPONENTS
+    try:
+        components = sorted({int(component) for component in value.split(',')})
+    except ValueError:
+        raise ValueError(f'Invalid components: {value}')
+    unknown = [component for component in components if component not in PROFILE_COMPONENTS]
+    if unknown:
+        raise ValueError(f'Unsupported components: {unknown}')
+    return components
+
 
 class CustomUserCreate(APIView):
     permission_classes = [AllowAny]
@@ -47,7 +76,7 @@ class BungieAuth(APIView):
             'client_secret': settings.SOCIAL_AUTH_BUNGIE_SECRET,
         }
 
-        response = requests.post(url, data=payload)
+        response = bungie.post(url, 'oauth', data=payload)
         response_data = response.json()
 
         if response.status_code != 200:
@@ -78,12 +107,13 @@ class BungieAuth(APIView):
                     'created_at': timezone.now(),
                 }
             )
+            forget_access_token(user.username)
 
             headers = {
                 'X-API-Key': settings.SOCIAL_AUTH_BUNGIE_API_KEY,
                 'Authorization': f'Bearer {access_token}',
             }
-            response = requests.get('https://www.bungie.net/Platform/User/GetMembershipsForCurrentUser/', headers=headers)
+            response = bungie.get('https://www.bungie.net/Platform/User/GetMembershipsForCurrentUser/', 'user', headers=headers)
             response_data = response.json()
 
             primary_membership_id = response_data.get('Response', {}).get('primaryMembershipId')
@@ -118,39 +148,16 @@ class BungieAuth(APIView):
 
 
 def refresh_bungie_token(username):
-    user_model = get_user_model()
-    user = user_model.objects.get(username=username)
-    token = OAuthToken.objects.get(user=user)
-    refresh_token = token.refresh_token
-    url = "https://www.bungie.net/platform/app/oauth/token/"
-
-    payload = {
-        'grant_type': 'refresh_token',
-        'refresh_token': refresh_token,
-    }
-    client_id_secret = f"{settings.SOCIAL_AUTH_BUNGIE_KEY}:{settings.SOCIAL_AUTH_BUNGIE_SECRET}"
-    client_id_secret_base64 = base64.b64encode(client_id_secret.encode()).decode()
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded',
-        'Authorization': f'Basic {client_id_secret_base64}'
-    }
-    response = requests.post(url, headers=headers, data=payload)
-    if response.status_code == 200:
-        response_data = response.json()
-        access_token = response_data.get('access_token')
-        expires_in = response_data.get('expires_in')
-        refresh_expires_in = response_data.get('refresh_expires_in')  # Get refresh_expires_in
-        expires = timezone.now() + timedelta(seconds=expires_in)
-        OAuthToken.objects.filter(user=user).update(
-            access_token=access_token, expires_in=expires_in, refresh_expires_in=refresh_expires_in, created_at=timezone.now())
-        return access_token
-    else:
-        raise Exception('Failed to refresh Bungie token')
+    # Always asks Bungie for a new token; request paths use get_access_token
+    return get_access_token(username, force_refresh=True)
 
 
-def is_destiny_api_enabled():
+def fetch_destiny_api_enabled():
     url = "https://www.bungie.net/Platform/Settings/"
-    response = requests.get(url)
+    try:
+        response = bungie.get(url, 'settings')
+    except requests.RequestException:
+        return True
     if response.status_code == 200:
         settings_data = response.json().get('Response', {})
         destiny_settings = settings_data.get('Destiny2', {})
@@ -158,6 +165,27 @@ def is_destiny_api_enabled():
     return True
 
 
+def refresh_destiny_api_status():
+    try:
+        status = {'enabled': fetch_destiny_api_enabled(), 'checked_at': time.time()}
+        cache.set(API_STATUS_CACHE_KEY, status, API_STATUS_STALE_SECONDS)
+    finally:
+        cache.delete(API_STATUS_REFRESH_KEY)
+        connection.close()
+
+
+def is_destiny_api_enabled():
+    # Serves the cached status and refreshes it in the background once it is
+    # older than the TTL, so requests never wait on the settings endpoint.
+    # Until the first check lands the API is assumed to be up.
+    status = cache.get(API_STATUS_CACHE_KEY)
+    if status is None or time.time() - status['checked_at'] >= API_STATUS_TTL_SECONDS:
+        # cache.add is atomic, so one worker refreshes while the others keep serving
+        if cache.add(API_STATUS_REFRESH_KEY, True, API_STATUS_REFRESH_TIMEOUT):
+            threading.Thread(target=refresh_destiny_api_status, daemon=True).start()
+    return True if status is None else status['enabled']
+
+
 class RefreshTokenView(APIView):
     def post(self, request, *args, **kwargs):
         username = request.data.get('username')
@@ -168,7 +196,7 @@ class RefreshTokenView(APIView):
             return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
 
         try:
-            access_token = refresh_bungie_token(user)
+            access_token = refresh_bungie_token(user.username)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -192,24 +220,27 @@ class BungieProfile(APIView):
             user = user_model.objects.get(username=username)
         except ObjectDoesNotExist:
             return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
-        primary_membership_id = user.primary_membership_id
-        membership_type = user.membership_type
+        # e.g. ?components=200,205&fields=itemHash,itemInstanceId,bucketHash
+        try:
+            components = parse_profile_components(request.query_params.get('components'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        fields = [field for field in request.query_params.get('fields', '').split(',') if field]
+
+        # Shared with concurrent requests for the same profile, e.g. the armor sync
         try:
-            access_token = refresh_bungie_token(username)
+            _, response_data = get_profile(user, components)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
-        headers = {
-            'X-API-Key': settings.SOCIAL_AUTH_BUNGIE_API_KEY,
-            'Authorization': f'Bearer {access_token}',
-        }
-        response = requests.get(f'https://www.bungie.net/Platform/Destiny2/{membership_type}/Profile/{primary_membership_id}/?components=100,102,200,201,205,300,302,304,305,308', headers=headers)
-        response_data = response.json()
 
-        # Call the sync_user_faves function
-        profile_items = response_data.get('Response', {}).get('itemComponents', {}).get('instances', {}).get('data', [])
-        sync_user_faves(user, profile_items)
+        # Call the sync_user_faves function; without item instances there is nothing to compare against
+        if 300 in components:
+            profile_items = response_data.get('Response', {}).get('itemComponents', {}).get('instances', {}).get('data', [])
+            sync_user_faves(user, profile_items)
 
-        return Response(response_data, status=status.HTTP_200_OK)
+        response_data = project_profile(response_data, components, fields)
+        # Profiles run to several MB, so they skip DRF's renderer
+        return HttpResponse(orjson.dumps(response_data), content_type='application/json', status=status.HTTP_200_OK)
 
 
 class TransferItem(APIView):
@@ -229,7 +260,7 @@ class TransferItem(APIView):
             return Response({'error': 'All fields are required'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            access_token = refresh_bungie_token(username)
+            access_token = get_access_token(username)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -247,9 +278,10 @@ class TransferItem(APIView):
             'membershipType': membershipType,
         }
 
-        response = requests.post('https://www.bungie.net/Platform/Destiny2/Actions/Items/TransferItem/', headers=headers, json=body)
+        response = bungie.post('https://www.bungie.net/Platform/Destiny2/Actions/Items/TransferItem/', 'action', headers=headers, json=body)
 
         if response.status_code == 200:
+            invalidate_profile(username)
             return Response(response.json(), status=status.HTTP_200_OK)
         else:
             return Response(response.json(), status=status.HTTP_400_BAD_REQUEST)
@@ -269,7 +301,7 @@ class EquipItem(APIView):
             return Response({'error': 'All fields are required'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            access_token = refresh_bungie_token(username)
+            access_token = get_access_token(username)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -284,9 +316,10 @@ class EquipItem(APIView):
             'membershipType': membershipType,
         }
 
-        response = requests.post('https://www.bungie.net/Platform/Destiny2/Actions/Items/EquipItem/', headers=headers, json=body)
+        response = bungie.post('https://www.bungie.net/Platform/Destiny2/Actions/Items/EquipItem/', 'action', headers=headers, json=body)
 
         if response.status_code == 200:
+            invalidate_profile(username)
             return Response(response.json(), status=status.HTTP_200_OK)
         else:
             return Response(response.json(), status=status.HTTP_400_BAD_REQUEST)
@@ -309,7 +342,7 @@ class EquipItems(APIView):
             return Response({'error': 'itemIds must be an array'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            access_token = refresh_bungie_token(username)
+            access_token = get_access_token(username)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -324,9 +357,10 @@ class EquipItems(APIView):
             'membershipType': membershipType,
         }
 
-        response = requests.post('https://www.bungie.net/Platform/Destiny2/Actions/Items/EquipItems/', headers=headers, json=body)
+        response = bungie.post('https://www.bungie.net/Platform/Destiny2/Actions/Items/EquipItems/', 'action', headers=headers, json=body)
 
         if response.status_code == 200:
+            invalidate_profile(username)
             return Response(response.json(), status=status.HTTP_200_OK)
         else:
             return Response(response.json(), status=status.HTTP_400_BAD_REQUEST)